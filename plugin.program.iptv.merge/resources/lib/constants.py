@@ -4,6 +4,9 @@ IPTV_SIMPLE_ID      = 'pvr.iptvsimple'
 METHOD_PLAYLIST     = 'playlist'
 METHOD_EPG          = 'epg'
 MERGE_SETTING_FILE  = '.iptv_merge'
+CHANNEL_BATCH_SIZE  = 5000
+SEARCH_TABLE        = 'channel_search'
+HTTP_MERGE_AGE      = 300 #5 Minutes
 
 TYPE_IPTV_MERGE = 1
 TYPE_IPTV_MANAGER = 2
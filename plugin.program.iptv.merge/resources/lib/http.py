@@ -1,9 +1,11 @@
 import os
+import re
+import time
 import threading
 import socket
+from email.utils import formatdate
 
-from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-from six.moves.socketserver import ThreadingMixIn
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler
 from six.moves.urllib.parse import unquote
 
 from kodi_six import xbmcvfs
@@ -12,12 +14,77 @@ from slyguy.log import log
 from slyguy import router, userdata, settings
 from slyguy.constants import CHUNK_SIZE
 from slyguy.util import check_port
+from slyguy.server import create_server
+
+from .constants import HTTP_MERGE_AGE
 
 HOST = '0.0.0.0'
 DEFAULT_PORT = 52104
 
 PLAYLIST_URL = 'playlist.m3u8'
 EPG_URL = 'epg.xml'
+SERVER_WORKERS = 4
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+FILES = {
+    '/'+PLAYLIST_URL.lower(): ('playlist', 'application/vnd.apple.mpegurl'),
+    '/'+EPG_URL.lower(): ('epg', 'text/xml'),
+}
+
+_locks = {'playlist': threading.Lock(), 'epg': threading.Lock()}
+_paths = {}
+
+def _merge(type, refresh):
+    path = router.url_for('run_merge', type=type, refresh=int(refresh))
+    log.debug('PLUGIN REQUEST: {}'.format(path))
+    dirs, files = xbmcvfs.listdir(path)
+    result, msg = int(files[0][0]), unquote(files[0][1:])
+    if not result:
+        raise Exception(msg)
+
+    if not os.path.exists(msg):
+        raise Exception('File not found: {}'.format(msg))
+
+    _paths[type] = msg
+    return msg
+
+def _is_stale(path):
+    if not path or not os.path.exists(path):
+        return True
+
+    return settings.getBool('http_force_merge', True) and time.time() - os.path.getmtime(path) > HTTP_MERGE_AGE
+
+def get_file(type):
+    path = _paths.get(type)
+    if not _is_stale(path):
+        return path
+
+    # Requests arriving while a merge is running wait on it and then use its output
+    with _locks[type]:
+        path = _paths.get(type)
+        if not _is_stale(path):
+            return path
+
+        if not path:
+            path = _merge(type, refresh=False)
+            if not _is_stale(path):
+                return path
+
+        return _merge(type, refresh=settings.getBool('http_force_merge', True))
+
+def _open_sidecar(path, f):
+    try:
+        gz_f = open(path + '.gz', 'rb')
+    except (IOError, OSError):
+        return None
+
+    ## Left over from an older merge
+    if os.fstat(gz_f.fileno()).st_mtime < os.fstat(f.fileno()).st_mtime:
+        gz_f.close()
+        return None
+
+    return gz_f
 
 class RequestHandler(BaseHTTPRequestHandler):
     def __init__(self, request, client_address, server):
@@ -28,43 +95,105 @@ class RequestHandler(BaseHTTPRequestHandler):
         return
 
     def do_GET(self):
-        if self.path.lower() == '/'+PLAYLIST_URL.lower():
-            path = router.url_for('run_merge', type='playlist', refresh=int(settings.getBool('http_force_merge', True)))
-            content_type = 'application/vnd.apple.mpegurl'
-        elif self.path.lower() == '/'+EPG_URL.lower():
-            path = router.url_for('run_merge', type='epg', refresh=int(settings.getBool('http_force_merge', True)))
-            content_type = 'text/xml'
-        else:
+        self._serve(head=False)
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def do_POST(self):
+        return
+
+    def _serve(self, head):
+        try:
+            type, content_type = FILES[self.path.lower()]
+        except KeyError:
             return
 
-        log.debug('PLUGIN REQUEST: {}'.format(path))
-        dirs, files = xbmcvfs.listdir(path)
-        result, msg = int(files[0][0]), unquote(files[0][1:])
-        if not result:
-            raise Exception(msg)
+        ## Merges swap the file in by rename. If it still can't be opened, resolve it again once before giving up
+        f = None
+        for i in range(2):
+            try:
+                path = get_file(type)
+                f = open(path, 'rb')
+                break
+            except (IOError, OSError) as e:
+                log.debug('Failed to open {}: {}'.format(type, e))
+
+        if f is None:
+            self.send_response(503)
+            self.send_header('Retry-After', '5')
+            self.end_headers()
+            return
 
-        if not os.path.exists(msg):
-            raise Exception('File not found: {}'.format(msg))
+        gz_f = None
+        try:
+            ## Pre-compressed sidecar written at merge time
+            if not self.headers.get('Range') and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                gz_f = _open_sidecar(path, f)
+
+            self._send_file(gz_f or f, os.fstat(f.fileno()), content_type, head, gzip=gz_f is not None)
+        finally:
+            f.close()
+            if gz_f: gz_f.close()
+
+    def _send_file(self, f, stat, content_type, head, gzip=False):
+        # Headers come from the open handles, so they match the content even if a merge replaces the file meanwhile
+        etag = '"{:x}-{:x}"'.format(stat.st_size, int(stat.st_mtime * 1000))
+        size = os.fstat(f.fileno()).st_size
+        range_header = self.headers.get('Range')
+        if gzip:
+            etag = etag[:-1] + '-gz"'
+
+        if etag in [x.strip() for x in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
 
-        self.send_response(200)
-        self.send_header('Content-Type', content_type)
-        self.end_headers()
+        start, end = 0, size - 1
+        status = 200
 
-        with open(msg, 'rb') as f:
-            while True:
-                chunk = f.read(CHUNK_SIZE)
-                if not chunk:
-                    break
-                self.wfile.write(chunk)
+        match = RANGE_RE.match(range_header.strip()) if range_header else None
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), size - 1)
+            else:
+                start = max(size - int(match.group(2)), 0)
 
-    def do_HEAD(self):
-        return
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.end_headers()
+                return
 
-    def do_POST(self):
-        return
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Last-Modified', formatdate(stat.st_mtime, usegmt=True))
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Vary', 'Accept-Encoding')
+        if gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        self.end_headers()
+
+        if head:
+            return
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    daemon_threads = True
+        remaining = end - start + 1
+        f.seek(start)
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
 
 userdata.set('_playlist_url', '')
 userdata.set('_epg_url', '')
@@ -80,7 +209,8 @@ class HTTP(object):
         if not port:
             port = check_port()
 
-        self._server = ThreadedHTTPServer((HOST, port), RequestHandler)
+        _paths.clear()
+        self._server = create_server((HOST, port), RequestHandler, workers=SERVER_WORKERS)
         self._server.allow_reuse_address = True
         self._httpd_thread = threading.Thread(target=self._server.serve_forever)
         self._httpd_thread.start()
@@ -1,36 +1,106 @@
+import os
+import sys
+import re
+import shutil
 import socket
 import json
 import codecs
-import arrow
-from xml.sax.saxutils import escape
+from contextlib import contextmanager
 
 from kodi_six import xbmc
 from six.moves.urllib.parse import parse_qsl, urlparse, urlencode, urlunparse
 
 from slyguy.constants import CHUNK_SIZE, KODI_VERSION
+from slyguy.util import remove_file
+from slyguy.xmltv import open_xmltv
+
+HIGH_SURROGATE_RE = re.compile(r'\\u[dD][89abAB][0-9a-fA-F]{2}$')
 
 def process_path(path, file_path):
     if not path.lower().startswith('plugin://'):
         raise Exception('Not implemented')
 
-    data = _get_data(path)
+    with _receive(path) as reader:
+        char = reader.peek()
+        if char is None:
+            raise Exception('No data returned from plugin')
 
-    if not isinstance(data, dict):
-        _write_raw(file_path, data)
-        return
+        if char == '"':
+            with codecs.open(file_path, 'w', encoding='utf8') as f:
+                reader.string(f.write)
+            return
 
-    if data.get('version', 1) > 1:
-        raise Exception('Unsupported version')
+        if char != '{':
+            _write_raw(file_path, reader.value())
+            return
+
+        _process_object(reader, file_path)
+
+def _process_object(reader, file_path):
+    # Channels / programmes are written as they are decoded so only one item is held in memory.
+    # Each key is written to its own file and only the winner is kept once the whole object is read,
+    # so version is checked first, epg wins over streams and a repeated key uses its last value (same as json.loads)
+    paths = {'epg': file_path + '_epg', 'streams': file_path + '_streams'}
+    version = 1
+
+    try:
+        for path in paths.values():
+            remove_file(path)
+
+        reader.expect('{')
+        while reader.peek() != '}':
+            key = reader.value()
+            reader.expect(':')
+
+            if key == 'version':
+                version = reader.value()
+
+            elif key == 'epg':
+                with open_xmltv(paths[key]) as writer:
+                    reader.expect('{')
+                    while reader.peek() != '}':
+                        channel_id = reader.value()
+                        reader.expect(':')
+                        writer.channel(channel_id)
+
+                        for item in reader.array():
+                            _write_programme(writer, channel_id, item)
+
+                        if reader.expect(',}') == '}':
+                            break
+                    else:
+                        reader.expect('}')
+
+            elif key == 'streams':
+                with codecs.open(paths[key], 'w', encoding='utf8') as f:
+                    f.write(u'#EXTM3U\n')
+                    for channel in reader.array():
+                        _write_channel(f, _fix_channel(channel))
+
+            else:
+                reader.value()
+
+            if reader.expect(',}') == '}':
+                break
+        else:
+            reader.expect('}')
+
+        if version > 1:
+            raise Exception('Unsupported version')
+
+        for key in ('epg', 'streams'):
+            if os.path.exists(paths[key]):
+                remove_file(file_path)
+                shutil.move(paths[key], file_path)
+                return
 
-    if 'epg' in data:
-        _write_epg(file_path, data)
-    elif 'streams' in data:
-        channels = _fix_channels(data)
-        _write_playlist(file_path, channels)
-    else:
         raise Exception('Unsupported data')
+    finally:
+        for path in paths.values():
+            remove_file(path)
 
-def _get_data(plugin_url):
+@contextmanager
+def _receive(plugin_url):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.bind(('localhost', 0))
     sock.listen(1)
@@ -49,125 +119,173 @@ def _get_data(plugin_url):
         conn, addr = sock.accept()
         conn.settimeout(None)
 
-        data = ''
-        while True:
-            chunk = conn.recv(CHUNK_SIZE)
-            if not chunk:
-                break
-            data += chunk.decode()
+        try:
+            yield JSONReader(conn.recv)
+        finally:
+            conn.close()
     except socket.timeout:
         raise Exception('Timout waiting for reply on port {}'.format(port))
     finally:
         sock.close()
 
-    if not data:
-        raise Exception('No data returned from plugin')
+class JSONReader(object):
+    # Incremental JSON reader. Bytes are decoded with an incremental utf8 decoder so characters split across reads are kept intact,
+    # and only the value being decoded (plus one read) is buffered
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self, read):
+        self._read = read
+        self._utf8 = codecs.getincrementaldecoder('utf8')()
+        self._json = json.JSONDecoder()
+        self._buffer = u''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+
+        chunk = self._read(CHUNK_SIZE)
+        if not chunk:
+            self._eof = True
+            text = self._utf8.decode(b'', True)
+        else:
+            text = self._utf8.decode(chunk)
+
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in self.WHITESPACE:
+                self._pos += 1
 
-    return json.loads(data)
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
 
-def _fix_channels(data):
-    channels = []
+            if not self._fill():
+                return None
 
-    for channel in data.get('streams', []):
-        # if not channel.get('logo'):
-        #     channel['logo'] = kodiutils.addon_icon(self.addon_obj)
-        # elif not channel.get('logo').startswith(('http://', 'https://', 'special://', 'resource://', '/')):
-        #     channel['logo'] = os.path.join(self.addon_path, channel.get('logo'))
+    def expect(self, chars):
+        char = self.peek()
+        if char is None or char not in chars:
+            raise ValueError('Expected one of "{}" at {}'.format(chars, char))
 
-        if not channel.get('group'):
-            channel['group'] = set()
-        elif isinstance(channel.get('group'), (bytes, str)):
-            channel['group'] = set(channel.get('group').split(';'))
-        elif sys.version_info.major == 2 and isinstance(channel.get('group'), unicode):
-            channel['group'] = set(channel.get('group').split(';'))
-        elif isinstance(channel.get('group'), list):
-            channel['group'] = set(list(channel.get('group')))
-        else:
-            channel['group'] = set()
+        self._pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+            else:
+                ## A number at the end of the buffer may continue in the next read
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+
+                self._fill()
+
+    def array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
 
-        channels.append(channel)
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+    def string(self, write):
+        # Decodes a (possibly huge) JSON string in pieces, cutting before any escape sequence that may be incomplete
+        self.expect('"')
 
-    return channels
+        while True:
+            end = self._buffer.find('"', self._pos)
+            while end >= 0:
+                slashes = 0
+                while end-1-slashes >= self._pos and self._buffer[end-1-slashes] == '\\':
+                    slashes += 1
+
+                if slashes % 2 == 0:
+                    break
+
+                end = self._buffer.find('"', end+1)
+
+            if end >= 0:
+                write(json.loads(u'"{}"'.format(self._buffer[self._pos:end])))
+                self._pos = end + 1
+                return
+
+            cut = len(self._buffer)
+            escape_pos = self._buffer.rfind('\\', max(self._pos, cut-6), cut)
+            if escape_pos >= 0:
+                cut = escape_pos
+                while cut > self._pos and self._buffer[cut-1] == '\\':
+                    cut -= 1
+
+            ## Keep escaped surrogate pairs together
+            if HIGH_SURROGATE_RE.search(self._buffer, max(self._pos, cut-6), cut):
+                cut -= 6
+
+            if cut > self._pos:
+                write(json.loads(u'"{}"'.format(self._buffer[self._pos:cut])))
+                self._pos = cut
+
+            if not self._fill():
+                raise ValueError('Unterminated string')
+
+def _fix_channel(channel):
+    # if not channel.get('logo'):
+    #     channel['logo'] = kodiutils.addon_icon(self.addon_obj)
+    # elif not channel.get('logo').startswith(('http://', 'https://', 'special://', 'resource://', '/')):
+    #     channel['logo'] = os.path.join(self.addon_path, channel.get('logo'))
+
+    if not channel.get('group'):
+        channel['group'] = set()
+    elif isinstance(channel.get('group'), (bytes, str)):
+        channel['group'] = set(channel.get('group').split(';'))
+    elif sys.version_info.major == 2 and isinstance(channel.get('group'), unicode):
+        channel['group'] = set(channel.get('group').split(';'))
+    elif isinstance(channel.get('group'), list):
+        channel['group'] = set(list(channel.get('group')))
+    else:
+        channel['group'] = set()
+
+    return channel
 
 def _write_raw(file_path, data):
     with codecs.open(file_path, 'w', encoding='utf8') as f:
         f.write(data)
 
-def _write_epg(file_path, data):
-    with codecs.open(file_path, 'w', encoding='utf8') as f:
-        f.write(u'<?xml version="1.0" encoding="utf-8" ?><tv>')
-
-        for channel_id in data['epg']:
-            f.write(u'<channel id="{}"></channel>'.format(escape(channel_id)))
-            for item in data['epg'][channel_id]:
-                title = item.get('title', '')
-                if KODI_VERSION < 19 and item.get('stream'):
-                    title = u'{} [COLOR green]\u2022[/COLOR][COLOR vod="{}"][/COLOR]'.format(title, item.get('stream'))
-
-                f.write(u'<programme start="{start}" stop="{stop}" channel="{channel}"{vod}><title>{title}</title>'.format(
-                    start = arrow.get(item.get('start')).format('YYYYMMDDHHmmss Z'),
-                    stop = arrow.get(item.get('stop')).format('YYYYMMDDHHmmss Z'),
-                    channel = escape(channel_id),
-                    vod = ' catchup-id="{}"'.format(escape(item['stream'])) if item.get('stream') else '',
-                    title = escape(title),
-                ))
-
-                if item.get('subtitle'):
-                    f.write(u'<sub-title>{}</sub-title>'.format(escape(item['subtitle'])))
-                if item.get('description'):
-                    f.write(u'<desc>{}</desc>'.format(escape(item['description'])))
-                if item.get('date'):
-                    f.write(u'<date>{}</date>'.format(escape(item['date'])))
-                if item.get('image'):
-                    f.write(u'<icon src="{}"/>'.format(escape(item['image'])))
-                if item.get('episode'):
-                    f.write(u'<episode-num system="onscreen">{}</episode-num>'.format(escape(item['episode'])))
-
-                if item.get('genre'):
-                    if not isinstance(item['genre'], list):
-                        item['genre'] = [item['genre']]
-
-                    for genre in item['genre']:
-                        f.write(u'<category>{}</category>'.format(escape(genre)))
-
-                if item.get('credits'):
-                    f.write(u'<credits>')
-                    for credit in item['credits']:
-                        if not credit.get('type') or not credit.get('name'):
-                            continue
-
-                        if credit['type'] in ('actor', 'presenter', 'commentator', 'guest'):
-                            elem = u'<actor role="{role}">{name}</actor>' if credit.get('role') else u'<actor>{}</actor>'
-                        elif credit['type'] in ('director', 'producer'):
-                            elem = u'<director>{name}</director>'
-                        elif credit['type'] in ('writer', 'adapter', 'composer', 'editor'):
-                            elem = u'<writer>{name}</writer>'
-                        else:
-                            continue
-
-                        f.write(elem.format(**credit))
-
-                f.write('</programme>')
-
-        f.write(u'</tv>')
-
-def _write_playlist(file_path, channels):
-    with codecs.open(file_path, 'w', encoding='utf8') as f:
-        f.write(u'#EXTM3U\n')
-
-        for channel in channels:
-            f.write(u'#EXTINF:-1 tvg-name="{name}"'.format(**channel))
-            if channel.get('id'):
-                f.write(u' tvg-id="{id}"'.format(**channel))
-            if channel.get('logo'):
-                f.write(u' tvg-logo="{logo}"'.format(**channel))
-            if channel.get('preset'):
-                f.write(u' tvg-chno="{preset}"'.format(**channel))
-            if channel.get('group'):
-                f.write(u' group-title="{groups}"'.format(groups=';'.join(channel.get('group'))))
-            if channel.get('radio'):
-                f.write(u' radio="true"')
-            f.write(u' catchup="vod",{name}\n'.format(**channel))
-            for key in channel.get('kodiprops', {}):
-                f.write(u'#KODIPROP:{key}={value}\n'.format(key=key, value=channe['kodiprops'][key]))
-            f.write(u'{stream}\n\n'.format(**channel))
\ No newline at end of file
+def _write_programme(writer, channel_id, item):
+    title = item.get('title', '')
+    if KODI_VERSION < 19 and item.get('stream'):
+        title = u'{} [COLOR green]\u2022[/COLOR][COLOR vod="{}"][/COLOR]'.format(title, item.get('stream'))
+
+    writer.programme(channel_id, item.get('start'), item.get('stop'), title, subtitle=item.get('subtitle'), desc=item.get('description'),
+        icon=item.get('image'), date=item.get('date'), episode=item.get('episode'), genre=item.get('genre'), credits=item.get('credits'), catchup_id=item.get('stream'))
+
+def _write_channel(f, channel):
+    f.write(u'#EXTINF:-1 tvg-name="{name}"'.format(**channel))
+    if channel.get('id'):
+        f.write(u' tvg-id="{id}"'.format(**channel))
+    if channel.get('logo'):
+        f.write(u' tvg-logo="{logo}"'.format(**channel))
+    if channel.get('preset'):
+        f.write(u' tvg-chno="{preset}"'.format(**channel))
+    if channel.get('group'):
+        f.write(u' group-title="{groups}"'.format(groups=';'.join(channel.get('group'))))
+    if channel.get('radio'):
+        f.write(u' radio="true"')
+    f.write(u' catchup="vod",{name}\n'.format(**channel))
+    for key in channel.get('kodiprops', {}):
+        f.write(u'#KODIPROP:{key}={value}\n'.format(key=key, value=channel['kodiprops'][key]))
+    f.write(u'{stream}\n\n'.format(**channel))
\ No newline at end of file
@@ -83,5 +83,11 @@ class Language(BaseLanguage):
     HTTP_SETTING           = 30079
     HTTP_FORCE_SETTING     = 30080
     REMOVE_EPG_ORPHANS     = 30081
+    MERGE_WORKERS          = 30082
+    INCREMENTAL_EPG        = 30083
+    EPG_DAYS_BACK          = 30084
+    EPG_DAYS_FORWARD       = 30085
+    DEDUPE_EPG             = 30086
+    ARCHIVE_TYPE_MISMATCH  = 30087
 
 _ = Language()
@@ -1,22 +1,30 @@
 import os
+import gzip
 import shutil
 import time
 import codecs
-import re
+import calendar
+import json
+import hashlib
+import threading
 import xml.parsers.expat
+from array import array
+from bisect import bisect_left
 
+import peewee
 from kodi_six import xbmc, xbmcvfs
+from six import PY2
 from six.moves.urllib.parse import unquote
 
 from slyguy import settings, database, gui, router
 from slyguy.log import log
-from slyguy.util import remove_file, hash_6, FileIO, gzip_extract, xz_extract, gdrivedl
+from slyguy.util import remove_file, hash_6, md5sum, FileIO, gzip_extract, xz_extract, gdrivedl
 from slyguy.session import Session
 from slyguy.constants import ADDON_PROFILE, CHUNK_SIZE
 from slyguy.exceptions import Error
 
 from .constants import *
-from .models import Source, Playlist, EPG, Channel, merge_info
+from .models import Source, Playlist, EPG, Channel, SourceState, merge_info, ATTRIBS_RE
 from .language import _
 from . import iptv_manager
 
@@ -26,6 +34,9 @@ def copy_partial_data(file_path, _out, start_index, end_index):
 
     try:
         with FileIO(file_path, 'rb', CHUNK_SIZE) as _in:
+            if _copy_range(_in, _out, start_index, end_index - start_index):
+                return True
+
             _seek_file(_in, start_index, truncate=False)
 
             while True:
@@ -40,6 +51,100 @@ def copy_partial_data(file_path, _out, start_index, end_index):
     except:
         return
 
+def _copy_range(_in, _out, offset, count):
+    # Let the kernel copy the byte range (reflink / in-kernel copy) when the platform supports it
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    if not copy_file_range and not sendfile:
+        return False
+
+    _out.flush()
+    out_index = _out.tell()
+    remaining = count
+
+    try:
+        in_fd, out_fd = _in.fileno(), _out.fileno()
+        os.lseek(out_fd, out_index, os.SEEK_SET)
+
+        while remaining > 0:
+            if copy_file_range:
+                copied = copy_file_range(in_fd, out_fd, remaining, offset)
+            else:
+                copied = sendfile(out_fd, in_fd, offset, remaining)
+
+            if not copied:
+                break
+
+            offset += copied
+            remaining -= copied
+    except Exception as e:
+        log.debug('Kernel copy failed, falling back to read / write ({})'.format(e))
+        _out.seek(out_index)
+        return False
+
+    if remaining:
+        _out.seek(out_index)
+        return False
+
+    _out.seek(out_index + count)
+    return True
+
+def _open_source(file_path, archive_type):
+    # Compressed EPGs are decompressed while parsing instead of being extracted to disk first
+    if archive_type == Source.ARCHIVE_AUTO:
+        archive_type = Source.auto_archive_type(file_path, file_path)
+
+    elif archive_type != Source.ARCHIVE_NONE and Source.auto_archive_type(file_path, file_path) != archive_type:
+        raise Error(_(_.ARCHIVE_TYPE_MISMATCH, archive_type=_.GZIP if archive_type == Source.ARCHIVE_GZIP else _.XZ))
+
+    if archive_type == Source.ARCHIVE_GZIP:
+        log.debug('Gzip Streaming: {}'.format(file_path))
+        return gzip.GzipFile(file_path, 'rb')
+
+    elif archive_type == Source.ARCHIVE_XZ:
+        if PY2:
+            raise Error(_.XZ_ERROR)
+
+        import lzma
+        log.debug('XZ Streaming: {}'.format(file_path))
+        return lzma.LZMAFile(file_path, 'rb')
+
+    return FileIO(file_path, 'rb')
+
+def _replace_file(src, dst):
+    # The HTTP API may be serving dst, so swap it in with a rename instead of removing it first
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        ## PY2 rename is already atomic on POSIX but fails on Windows if dst exists
+        try:
+            os.rename(src, dst)
+        except OSError:
+            remove_file(dst)
+            os.rename(src, dst)
+
+def _write_sidecar(file_path):
+    # Gzip copy served by the HTTP API to clients sending Accept-Encoding: gzip
+    gz_path = file_path + '.gz'
+    if not settings.getBool('http_api', False):
+        remove_file(gz_path)
+        return
+
+    tmp_path = gz_path + '_tmp'
+    try:
+        with open(file_path, 'rb') as f_in:
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
+
+        _replace_file(tmp_path, gz_path)
+    except Exception as e:
+        log.exception(e)
+        remove_file(tmp_path)
+        remove_file(gz_path)
+
+def _context_hash(*values):
+    return hashlib.md5(json.dumps(values).encode('utf8')).hexdigest()
+
 def _seek_file(f, index, truncate=True):
     cur_index = f.tell()
     if cur_index != index:
@@ -51,9 +156,77 @@ def _seek_file(f, index, truncate=True):
 class AddonError(Error):
     pass
 
+def _xmltv_time(value):
+    # XMLTV times are "YYYYMMDDhhmmss +zzzz" with optional seconds / offset
+    digits, sep, offset = value.strip().partition(' ')
+    if len(digits) > 14 and digits[14] in '+-':
+        digits, offset = digits[:14], digits[14:]
+
+    timestamp = calendar.timegm((int(digits[0:4]), int(digits[4:6]), int(digits[6:8]), int(digits[8:10] or 0), int(digits[10:12] or 0), int(digits[12:14] or 0)))
+
+    offset = offset.strip()
+    if len(offset) == 5 and offset[0] in '+-':
+        seconds = int(offset[1:3])*3600 + int(offset[3:5])*60
+        timestamp += -seconds if offset[0] == '+' else seconds
+
+    return timestamp
+
+class ProgrammeIndex(object):
+    # Per channel start times with a running max of stop times, so an overlap check is a single bisect.
+    # Entries from the source being parsed are pending until commit so a source never dedupes against itself
+    def __init__(self):
+        self._channels = {}
+        self._channel_ids = set()
+        self._pending = {}
+        self._pending_ids = set()
+
+    def has_channel(self, channel_id):
+        return channel_id in self._channel_ids
+
+    def add_channel(self, channel_id):
+        self._pending_ids.add(channel_id)
+
+    def overlaps(self, channel_id, start, stop):
+        if channel_id not in self._channels:
+            return False
+
+        starts, stops, max_stops = self._channels[channel_id]
+        i = bisect_left(starts, stop)
+        return i > 0 and max_stops[i-1] > start
+
+    def add(self, channel_id, start, stop):
+        self._pending.setdefault(channel_id, []).append((start, stop))
+
+    def commit(self):
+        for channel_id, pending in self._pending.items():
+            if channel_id in self._channels:
+                starts, stops, max_stops = self._channels[channel_id]
+                pending.extend(zip(starts, stops))
+
+            pending.sort()
+            starts, stops, max_stops = array('l'), array('l'), array('l')
+            max_stop = None
+            for start, stop in pending:
+                max_stop = stop if max_stop is None else max(max_stop, stop)
+                starts.append(start)
+                stops.append(stop)
+                max_stops.append(max_stop)
+
+            self._channels[channel_id] = (starts, stops, max_stops)
+
+        self._channel_ids.update(self._pending_ids)
+        self.rollback()
+
+    def rollback(self):
+        self._pending = {}
+        self._pending_ids = set()
+
 class XMLParser(object):
-    def __init__(self, out, epg_ids=None):
+    def __init__(self, out, epg_ids=None, min_time=None, max_time=None, index=None):
         self._out = out
+        self._min_time = min_time
+        self._max_time = max_time
+        self._index = index
 
         if epg_ids is None:
             self._epg_ids = set()
@@ -72,12 +245,14 @@ class XMLParser(object):
         self._parser.StartElementHandler = self._start_element
         self._parser.EndElementHandler = self._end_element
 
-        self._buffer = b''
-        self._offset = 0
+        # Raw input from byte _base onwards. _mark is where the current element started
+        self._buffer = bytearray()
+        self._base = 0
+        self._mark = 0
         self._add = False
 
     def epg_count(self):
-        if self._check_orphans:
+        if self._check_orphans or self._min_time or self._max_time or self._index:
             return 'Added {added} / Skipped {skipped}'.format(**self._counts['programme'])
         else:
             return 'Added {added}'.format(**self._counts['programme'])
@@ -86,30 +261,62 @@ class XMLParser(object):
         if name not in ('channel', 'programme'):
             return
 
-        self._buffer = self._buffer[self._parser.CurrentByteIndex-self._offset:]
-        self._offset = self._parser.CurrentByteIndex
-
-        if not self._check_orphans:
-            self._add = True
-            return
+        self._mark = self._parser.CurrentByteIndex
 
         if name == 'programme':
-            self._add = 'channel' in attrs and attrs['channel'] in self._epg_ids
+            self._add = (not self._check_orphans or attrs.get('channel') in self._epg_ids) and self._check_times(attrs)
         elif name == 'channel':
-            self._add = 'id' in attrs and attrs['id'] in self._epg_ids
+            self._add = not self._check_orphans or attrs.get('id') in self._epg_ids
+            if self._add and self._index:
+                self._add = not self._index.has_channel(attrs.get('id'))
+                self._index.add_channel(attrs.get('id'))
+
+    def _check_times(self, attrs):
+        if not self._min_time and not self._max_time and not self._index:
+            return True
+
+        try:
+            start = _xmltv_time(attrs['start'])
+            stop = _xmltv_time(attrs['stop']) if attrs.get('stop') else start
+        except (KeyError, ValueError, IndexError):
+            return True
+
+        if self._min_time and stop < self._min_time:
+            return False
+
+        if self._max_time and start > self._max_time:
+            return False
+
+        if self._index:
+            if self._index.overlaps(attrs.get('channel'), start, stop):
+                return False
+
+            self._index.add(attrs.get('channel'), start, stop)
+
+        return True
 
     def _end_element(self, name):
         if name not in ('channel', 'programme'):
             return
 
+        index = self._parser.CurrentByteIndex
+
         if self._add:
             self._counts[name]['added'] += 1
-            self._out.write(self._buffer[:self._parser.CurrentByteIndex-self._offset] + (b'</programme>' if name == 'programme' else b'</channel>'))
+            self._out.write(self._buffer[self._mark-self._base:index-self._base])
+            self._out.write(b'</programme>' if name == 'programme' else b'</channel>')
         else:
             self._counts[name]['skipped'] += 1
 
-        self._buffer = self._buffer[self._parser.CurrentByteIndex-self._offset:]
-        self._offset = self._parser.CurrentByteIndex
+        self._mark = index
+
+    def _feed(self, chunk):
+        self._buffer += chunk
+        self._parser.Parse(chunk)
+
+        ## Drop everything before the element in progress once per chunk
+        del self._buffer[:self._mark-self._base]
+        self._base = self._mark
 
     def parse(self, _in, epg):
         epg.start_index = self._out.tell()
@@ -119,11 +326,107 @@ class XMLParser(object):
             if not chunk:
                 break
 
-            self._buffer += chunk
-            self._parser.Parse(chunk)
+            self._feed(chunk)
+
+        self._out.flush()
+        epg.end_index = self._out.tell()
+
+    def parse_range(self, file_path, start_index, end_index, epg):
+        # Re-parses a source's elements from a previous merged output
+        if start_index < 1 or end_index < start_index:
+            return False
+
+        out_index = self._out.tell()
+
+        with FileIO(file_path, 'rb') as _in:
+            _in.seek(start_index)
+            self._feed(b'<tv>')
+
+            while _in.tell() < end_index:
+                chunk = _in.read(min(CHUNK_SIZE, end_index - _in.tell()))
+                if not chunk:
+                    return False
+
+                self._feed(chunk)
+
+            self._feed(b'</tv>')
 
         self._out.flush()
+        epg.start_index = out_index
         epg.end_index = self._out.tell()
+        return True
+
+class SourceFetcher(object):
+    # Downloads / extracts sources in a bounded pool, each to its own file. Results are handed out in source order
+    def __init__(self, fetch, sources, tmp_path, workers):
+        self._fetch = fetch
+        self._sources = sources
+        self._tmp_path = tmp_path
+        self._ahead = max(1, workers)
+        self._results = {}
+        self._next = 0
+        self._consumed = 0
+        self._stopped = False
+        self._cond = threading.Condition()
+
+        self._threads = []
+        for i in range(min(self._ahead, len(sources))):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _file_path(self, index):
+        return '{}_{}'.format(self._tmp_path, index)
+
+    def _worker(self):
+        # peewee connections are per thread, so each worker closes its own
+        with database.db.connection_context():
+            while True:
+                with self._cond:
+                    while not self._stopped and self._next < len(self._sources) and self._next >= self._consumed + self._ahead:
+                        self._cond.wait()
+
+                    if self._stopped or self._next >= len(self._sources):
+                        return
+
+                    index = self._next
+                    self._next += 1
+
+                file_path = self._file_path(index)
+                start = time.time()
+
+                ## BaseException (eg. Exit from a source add-on) is handed back too, otherwise get() would wait forever
+                try:
+                    value = self._fetch(index, self._sources[index], file_path)
+                except BaseException as e:
+                    result = (file_path, None, e, time.time() - start)
+                else:
+                    result = (file_path, value, None, time.time() - start)
+
+                with self._cond:
+                    self._results[index] = result
+                    self._cond.notify_all()
+
+    def get(self, index):
+        with self._cond:
+            while index not in self._results:
+                self._cond.wait()
+
+            self._consumed = index + 1
+            self._cond.notify_all()
+            return self._results.pop(index)
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+
+        for index in range(len(self._sources)):
+            remove_file(self._file_path(index))
 
 class Merger(object):
     def __init__(self, output_path=None, forced=False):
@@ -152,7 +455,22 @@ class Merger(object):
         if not result:
             raise AddonError(msg)
 
-    def _process_source(self, source, method_name, file_path):
+    def _fetch_source(self, source, method_name, file_path, state, reusable):
+        # Returns True when the source is known to match the output of the last successful merge
+        if self._process_source(source, method_name, file_path, state, conditional=reusable):
+            log.debug('Not modified: {}'.format(source.path))
+            return True
+
+        content_hash = md5sum(file_path)
+        unchanged = reusable and content_hash is not None and content_hash == state.content_hash
+        state.content_hash = content_hash
+
+        if unchanged:
+            log.debug('Content unchanged: {}'.format(source.path))
+
+        return unchanged
+
+    def _process_source(self, source, method_name, file_path, state=None, conditional=False):
         remove_file(file_path)
 
         path         = source.path.strip()
@@ -196,16 +514,32 @@ class Merger(object):
                 log.debug('Gdrive Downloading: {} > {}'.format(path, file_path))
                 path = gdrivedl(path, file_path)
             else:
+                headers = {}
+                if conditional and state.etag:
+                    headers['If-None-Match'] = state.etag
+                if conditional and state.last_modified:
+                    headers['If-Modified-Since'] = state.last_modified
+
                 log.debug('Downloading: {} > {}'.format(path, file_path))
-                Session().chunked_dl(path, file_path)
+                resp = Session().chunked_dl(path, file_path, headers=headers)
+                if resp.status_code == 304:
+                    return True
+
+                if state:
+                    state.etag = resp.headers.get('ETag')
+                    state.last_modified = resp.headers.get('Last-Modified')
         elif not xbmcvfs.exists(path):
             raise Error(_(_.LOCAL_PATH_MISSING, path=path))
         else:
             log.debug('Copying local file: {} > {}'.format(path, file_path))
             xbmcvfs.copy(path, file_path)
 
+        ## EPGs are decompressed by _open_source while parsing
+        if method_name == METHOD_EPG:
+            return
+
         if archive_type == Source.ARCHIVE_AUTO:
-            archive_type = Source.auto_archive_type(path)
+            archive_type = Source.auto_archive_type(path, file_path)
 
         if archive_type == Source.ARCHIVE_GZIP:
             gzip_extract(file_path)
@@ -214,7 +548,7 @@ class Merger(object):
 
     def _process_playlist(self, playlist, file_path):
         channel     = None
-        to_create   = set()
+        to_create   = []
         slugs       = set()
         added_count = 0
 
@@ -245,7 +579,7 @@ class Merger(object):
 
                     #if not playlist.ignore_playlist_epg:
                     attribs = {}
-                    for key, value in re.findall('([\w-]+)="([^"]*)"', line):
+                    for key, value in ATTRIBS_RE.findall(line):
                         attribs[key] = value.strip()
 
                     xml_urls = attribs.get('x-tvg-url', '').split(',')
@@ -262,10 +596,11 @@ class Merger(object):
                         default_attribs['catchup-correction'] = attribs['catchup-correction']
 
                 if line.startswith('#EXTINF'):
-                    channel = Channel.from_playlist(line)
+                    channel = Channel.parse_extinf(line)
+                    channel['properties'] = {}
                     for key in default_attribs:
-                        if key not in channel.attribs:
-                            channel.attribs[key] = default_attribs[key]
+                        if key not in channel['attribs']:
+                            channel['attribs'][key] = default_attribs[key]
 
                 elif not channel:
                     continue
@@ -273,66 +608,67 @@ class Merger(object):
                 if line.startswith('#EXTGRP'):
                     value = line.split(':',1)[1].strip()
                     if value:
-                        channel.groups.extend(value.split(';'))
+                        channel['groups'].extend(value.split(';'))
 
                 elif line.startswith('#KODIPROP') or line.startswith('#EXTVLCOPT'):
                     value = line.split(':',1)[1].strip()
                     if value and '=' in value:
                         key, value = value.split('=', 1)
-                        channel.properties[key] = value
+                        channel['properties'][key] = value
 
                 elif line.startswith('#EXT-X-PLAYLIST-TYPE'):
                     value = line.split(':',1)[1].strip()
                     if value and value.upper() == 'VOD':
-                        channel.is_live = False
+                        channel['is_live'] = False
 
                 elif not line.startswith('#'):
-                    channel.url = line
-                    if not channel.url:
+                    channel['url'] = line
+                    if not channel['url']:
                         channel = None
                         continue
 
-                    channel.playlist = playlist
+                    channel['playlist'] = playlist.id
 
                     if playlist.skip_playlist_groups:
-                        channel.groups = []
+                        channel['groups'] = []
 
                     if playlist.group_name:
-                        channel.groups.extend(playlist.group_name.split(';'))
+                        channel['groups'].extend(playlist.group_name.split(';'))
 
                     if playlist.skip_playlist_chno:
-                        channel.chno = None
+                        channel['chno'] = None
 
                     if playlist.use_start_chno:
-                        if channel.radio:
-                            if channel.chno is None:
-                                channel.chno = chnos['radio']
+                        if channel['radio']:
+                            if channel['chno'] is None:
+                                channel['chno'] = chnos['radio']
 
-                            chnos['radio'] = channel.chno + 1
+                            chnos['radio'] = channel['chno'] + 1
                         else:
-                            if channel.chno is None:
-                                channel.chno = chnos['tv']
+                            if channel['chno'] is None:
+                                channel['chno'] = chnos['tv']
 
-                            chnos['tv'] = channel.chno + 1
+                            chnos['tv'] = channel['chno'] + 1
 
                     if free_iptv:
-                        channel.url = TROLL_URL
+                        channel['url'] = TROLL_URL
 
-                    channel.groups = [x for x in channel.groups if x.strip()]
-                    channel.visible = playlist.default_visible
-                    channel.slug = slug = '{}.{}'.format(playlist.id, hash_6(channel.epg_id or channel.url.lower().strip()))
-                    channel.order = added_count + 1
+                    channel['groups'] = [x for x in channel['groups'] if x.strip()]
+                    channel['visible'] = playlist.default_visible
+                    channel['slug'] = slug = '{}.{}'.format(playlist.id, hash_6(channel['epg_id'] or channel['url'].lower().strip()))
+                    channel['order'] = added_count + 1
 
                     count = 1
-                    while channel.slug in slugs:
-                        channel.slug = '{}.{}'.format(slug, count)
+                    while channel['slug'] in slugs:
+                        channel['slug'] = '{}.{}'.format(slug, count)
                         count += 1
 
-                    slugs.add(channel.slug)
-                    to_create.add(channel)
+                    slugs.add(channel['slug'])
+                    to_create.append(channel)
 
-                    if Channel.bulk_create_lazy(to_create):
-                        to_create.clear()
+                    if len(to_create) >= CHANNEL_BATCH_SIZE:
+                        Channel.insert_rows(to_create)
+                        to_create = []
 
                     channel = None
                     added_count += 1
@@ -340,8 +676,7 @@ class Merger(object):
         if not valid_file:
             raise Error('Invalid playlist - Does not start with #EXTM3U')
 
-        Channel.bulk_create_lazy(to_create, force=True)
-        to_create.clear()
+        Channel.insert_rows(to_create)
         slugs.clear()
 
         return added_count
@@ -352,7 +687,9 @@ class Merger(object):
             return playlist_path
 
         start_time = time.time()
+        playlist_path_tmp = os.path.join(self.output_path, PLAYLIST_FILE_NAME+'_tmp')
         database.connect()
+        fetcher = None
 
         try:
             progress = gui.progressbg() if self.forced else None
@@ -361,28 +698,50 @@ class Merger(object):
             Playlist.update({Playlist.results: []}).where(Playlist.enabled == False).execute()
             Channel.delete().where(Channel.custom == False, Channel.playlist.not_in(playlists)).execute()
 
-            for count, playlist in enumerate(playlists):
-                count += 1
+            states   = SourceState.for_sources(playlists, 'playlist')
+            contexts = [_context_hash(x.path.strip(), x.source_type, x.archive_type, x.skip_playlist_chno, x.use_start_chno, x.start_chno, x.default_visible, x.skip_playlist_groups, x.group_name) for x in playlists]
+
+            ## Unchanged playlists keep their channel rows, so they can't be reused if those rows are gone (eg. table rebuilt)
+            channel_counts = dict(Channel.select(Channel.playlist, peewee.fn.COUNT(Channel.slug)).group_by(Channel.playlist).tuples())
+            reusable = [bool(x.results) and x.results[0][1] == Playlist.OK and states[i].context_hash == contexts[i] and channel_counts.get(x.id, 0) > 0 for i, x in enumerate(playlists)]
 
-                if progress: progress.update(int(count*(100/len(playlists))), 'Merging Playlist ({}/{})'.format(count, len(playlists)), _(playlist.label, _bold=True))
+            def fetch(index, playlist, file_path):
+                if playlist.source_type != Playlist.TYPE_CUSTOM:
+                    log.debug('Processing: {}'.format(playlist.path))
+                    return self._fetch_source(playlist, METHOD_PLAYLIST, file_path, states[index], reusable[index])
+
+            fetcher = SourceFetcher(fetch, playlists, self.tmp_file, settings.getInt('merge_workers', 4))
+
+            for count, playlist in enumerate(playlists):
+                if progress: progress.update(int((count+1)*(100/len(playlists))), 'Merging Playlist ({}/{})'.format(count+1, len(playlists)), _(playlist.label, _bold=True))
 
-                playlist_start = time.time()
+                file_path, unchanged, error, fetch_time = fetcher.get(count)
+                parse_start = time.time()
+                state = states[count]
 
-                error = None
                 try:
-                    log.debug('Processing: {}'.format(playlist.path))
+                    if error:
+                        raise error
 
-                    if playlist.source_type != Playlist.TYPE_CUSTOM:
-                        self._process_source(playlist, METHOD_PLAYLIST, self.tmp_file)
+                    if playlist.source_type == Playlist.TYPE_CUSTOM:
+                        added = len(playlist.channels)
+                    elif unchanged:
+                        added = playlist.channels.count()
+                        self._playlist_epgs.extend(state.epg_urls)
+                        state.save()
+                    else:
+                        epg_start = len(self._playlist_epgs)
 
                         with database.db.atomic() as transaction:
                             try:
-                                added = self._process_playlist(playlist, self.tmp_file)
+                                added = self._process_playlist(playlist, file_path)
                             except:
                                 transaction.rollback()
                                 raise
-                    else:
-                        added = len(playlist.channels)
+
+                        state.epg_urls = self._playlist_epgs[epg_start:]
+                        state.context_hash = contexts[count]
+                        state.save()
                 except AddonError as e:
                     error = e
                 except Error as e:
@@ -392,7 +751,12 @@ class Merger(object):
                     error = e
                     log.exception(e)
                 else:
-                    playlist.results.insert(0, [int(time.time()), Playlist.OK, '{} Channels ({:.2f}s)'.format(added, time.time() - playlist_start)])
+                    if unchanged:
+                        message = '{} Channels ({:.2f}s fetch / unchanged)'.format(added, fetch_time)
+                    else:
+                        message = '{} Channels ({:.2f}s fetch / {:.2f}s parse)'.format(added, fetch_time, time.time() - parse_start)
+
+                    playlist.results.insert(0, [int(time.time()), Playlist.OK, message])
                     error = None
 
                 if error:
@@ -402,7 +766,7 @@ class Merger(object):
                     else:
                         playlist.results.insert(0, result)
 
-                remove_file(self.tmp_file)
+                remove_file(file_path)
 
                 playlist.results = playlist.results[:3]
                 playlist.save()
@@ -410,7 +774,7 @@ class Merger(object):
             count = 0
             starting_ch_no = settings.getInt('start_ch_no', 1)
 
-            with codecs.open(playlist_path, 'w', encoding='utf8') as outfile:
+            with codecs.open(playlist_path_tmp, 'w', encoding='utf8') as outfile:
                 outfile.write(u'#EXTM3U')
 
                 group_order = settings.get('group_order')
@@ -455,10 +819,16 @@ class Merger(object):
                 if count == 0:
                     outfile.write(u'\n\n#EXTINF:-1,EMPTY PLAYLIST\nhttp')
 
+            _replace_file(playlist_path_tmp, playlist_path)
+            _write_sidecar(playlist_path)
+
             log.debug('Wrote {} Channels'.format(count))
             Playlist.after_merge()
         finally:
             if progress: progress.close()
+            if fetcher: fetcher.close()
+
+            remove_file(playlist_path_tmp)
             database.close()
 
         log.debug('Playlist Merge Time: {0:.2f}'.format(time.time() - start_time))
@@ -473,6 +843,7 @@ class Merger(object):
         start_time = time.time()
         epg_path_tmp = os.path.join(self.output_path, EPG_FILE_NAME+'_tmp')
         database.connect()
+        fetcher = None
 
         try:
             progress = gui.progressbg() if self.forced else None
@@ -493,31 +864,102 @@ class Merger(object):
                         epgs.append(epg)
                         epg_urls.append(url.lower())
 
+            ## Playlist provided EPGs have no row, so their last output range is kept with their state
+            states = SourceState.for_sources(epgs, 'epg')
+            for epg, state in zip(epgs, states):
+                if not epg.id:
+                    epg.start_index = state.start_index
+                    epg.end_index = state.end_index
+
+            ## Window limits move with time, so reused output is only valid for the day it was built
+            days_back = settings.getInt('epg_days_back', 0)
+            days_forward = settings.getInt('epg_days_forward', 0)
+            now = int(time.time())
+            min_time = now - days_back*86400 if days_back else None
+            max_time = now + days_forward*86400 if days_forward else None
+            window = [days_back, days_forward, now // 86400] if days_back or days_forward else None
+
+            ## Later sources only keep programmes that don't overlap ones already added for the same channel
+            dedupe = settings.getBool('dedupe_epg', False)
+            index = ProgrammeIndex() if dedupe else None
+            changed = False
+
+            ## Removing, disabling or reordering an earlier source changes what a later one keeps, so the sources before it are part of its context
+            ids_hash = _context_hash(sorted(epg_ids) if epg_ids is not None else None)
+            contexts = [_context_hash(x.path.strip(), x.source_type, x.archive_type, ids_hash, window, dedupe, [y.key for y in states[:i]] if dedupe else None) for i, x in enumerate(epgs)]
+            incremental = settings.getBool('incremental_epg', True)
+            reusable = [incremental and x.start_index > 0 and os.path.exists(epg_path) and states[i].context_hash == contexts[i] for i, x in enumerate(epgs)]
+
+            def fetch(index, epg, file_path):
+                log.debug('Processing: {}'.format(epg.path))
+                return self._fetch_source(epg, METHOD_EPG, file_path, states[index], reusable[index])
+
+            fetcher = SourceFetcher(fetch, epgs, self.tmp_file, settings.getInt('merge_workers', 4))
+
             with FileIO(epg_path_tmp, 'wb') as _out:
                 _out.write(b'<?xml version="1.0" encoding="UTF-8"?><tv>')
 
                 for count, epg in enumerate(epgs):
-                    count += 1
-
-                    if progress: progress.update(int(count*(100/len(epgs))), 'Merging EPG ({}/{})'.format(count, len(epgs)), _(epg.label, _bold=True))
+                    if progress: progress.update(int((count+1)*(100/len(epgs))), 'Merging EPG ({}/{})'.format(count+1, len(epgs)), _(epg.label, _bold=True))
 
                     file_index = _out.tell()
 
-                    epg_start = time.time()
+                    file_path, unchanged, error, fetch_time = fetcher.get(count)
+                    parse_start = time.time()
+                    state = states[count]
+
                     try:
-                        log.debug('Processing: {}'.format(epg.path))
-                        self._process_source(epg, METHOD_EPG, self.tmp_file)
-                        with FileIO(self.tmp_file, 'rb') as _in:
-                            parser = XMLParser(_out, epg_ids)
-                            parser.parse(_in, epg)
+                        if error:
+                            raise error
+
+                        ## When deduping, earlier sources decide what this one keeps, so it can only be reused if none of them changed.
+                        ## Its previous output is parsed again (without downloading) to fill the index
+                        reused = False
+                        if unchanged and index and not changed:
+                            parser = XMLParser(_out, epg_ids, min_time, max_time, index)
+                            reused = parser.parse_range(epg_path, epg.start_index, epg.end_index, epg)
+                        elif unchanged and not index:
+                            reused = copy_partial_data(epg_path, _out, epg.start_index, epg.end_index)
+                            if reused:
+                                epg.start_index = file_index
+                                epg.end_index = _out.tell()
+
+                        if reused:
+                            message = 'Unchanged ({:.2f}s fetch)'.format(fetch_time)
+                        else:
+                            if unchanged:
+                                _seek_file(_out, file_index)
+                                if index: index.rollback()
+
+                                ## A matching hash leaves the download on disk, only a 304 has nothing to parse
+                                if not os.path.exists(file_path):
+                                    log.debug('Unable to reuse last XML data, downloading again')
+                                    self._fetch_source(epg, METHOD_EPG, file_path, state, reusable=False)
+                                    parse_start = time.time()
+
+                            changed = True
+                            with _open_source(file_path, epg.archive_type) as _in:
+                                parser = XMLParser(_out, epg_ids, min_time, max_time, index)
+                                parser.parse(_in, epg)
+
+                            message = '{} ({:.2f}s fetch / {:.2f}s parse)'.format(parser.epg_count(), fetch_time, time.time() - parse_start)
+
+                        if index: index.commit()
+
+                        state.context_hash = contexts[count]
+                        state.start_index = epg.start_index
+                        state.end_index = epg.end_index
+                        state.save()
                     except Exception as e:
                         log.exception(e)
                         result = [int(time.time()), EPG.ERROR, str(e)]
                     else:
-                        result = [int(time.time()), EPG.OK, '{} ({:.2f}s)'.format(parser.epg_count(), time.time() - epg_start)]
+                        result = [int(time.time()), EPG.OK, message]
                         epg.results.insert(0, result)
 
                     if result[1] == EPG.ERROR:
+                        changed = True
+                        if index: index.rollback()
                         _seek_file(_out, file_index)
 
                         if epg.start_index > 0:
@@ -536,19 +978,21 @@ class Merger(object):
                         else:
                             epg.results.insert(0, result)
 
+                        SourceState.update({SourceState.start_index: epg.start_index, SourceState.end_index: epg.end_index}).where(SourceState.key == state.key).execute()
+
                     epg.results = epg.results[:3]
                     if epg.id:
                         epg.save()
-                    remove_file(self.tmp_file)
+                    remove_file(file_path)
 
                 _out.write(b'</tv>')
 
-            remove_file(epg_path)
-            shutil.move(epg_path_tmp, epg_path)
+            _replace_file(epg_path_tmp, epg_path)
+            _write_sidecar(epg_path)
         finally:
             if progress: progress.close()
+            if fetcher: fetcher.close()
 
-            remove_file(self.tmp_file)
             remove_file(epg_path_tmp)
             database.close()
 
@@ -20,6 +20,50 @@ from slyguy.log import log
 from .constants import *
 from .language import _
 
+ATTRIBS_RE = re.compile(r'([\w-]+)="([^"]*)"')
+
+JSON_SUPPORTED = None
+
+def _json_supported():
+    global JSON_SUPPORTED
+
+    if JSON_SUPPORTED is None:
+        try:
+            database.db.execute_sql("SELECT json_patch('{}', json_extract('{}', '$.a'))")
+        except Exception as e:
+            log.debug('SQLite JSON1 not available ({}), overrides will be applied in python'.format(e))
+            JSON_SUPPORTED = False
+        else:
+            JSON_SUPPORTED = True
+
+    return JSON_SUPPORTED
+
+SEARCH_SUPPORTED = None
+
+def _search_supported():
+    global SEARCH_SUPPORTED
+
+    if SEARCH_SUPPORTED is None:
+        try:
+            if not _json_supported():
+                raise Exception('JSON1 required')
+
+            database.db.execute_sql('CREATE VIRTUAL TABLE IF NOT EXISTS "{}" USING fts5(slug UNINDEXED, text, tokenize=\'trigram\')'.format(SEARCH_TABLE))
+        except Exception as e:
+            log.debug('SQLite FTS5 trigram search not available ({}), falling back to LIKE'.format(e))
+            SEARCH_SUPPORTED = False
+        else:
+            SEARCH_SUPPORTED = True
+
+    return SEARCH_SUPPORTED
+
+def _keyset(keys, values):
+    # (k1, k2, ..) > (v1, v2, ..) without relying on row value support
+    expr = keys[-1] > values[-1]
+    for key, value in reversed(list(zip(keys[:-1], values[:-1]))):
+        expr = (key > value) | ((key == value) & expr)
+    return expr
+
 @plugin.route()
 def play_channel(slug, **kwargs):
     channel = Channel.get_by_id(slug)
@@ -231,7 +275,21 @@ class Source(database.Model):
         return True
 
     @staticmethod
-    def auto_archive_type(path):
+    def auto_archive_type(path, file_path=None):
+        if file_path:
+            try:
+                with open(file_path, 'rb') as f:
+                    magic = f.read(6)
+            except (IOError, OSError):
+                pass
+            else:
+                if magic.startswith(b'\x1f\x8b'):
+                    return Source.ARCHIVE_GZIP
+                elif magic == b'\xfd7zXZ\x00':
+                    return Source.ARCHIVE_XZ
+                else:
+                    return Source.ARCHIVE_NONE
+
         archive_extensions = {
             '.gz': Source.ARCHIVE_GZIP,
             '.xz': Source.ARCHIVE_XZ,
@@ -504,43 +562,117 @@ class Channel(database.Model):
 
     @classmethod
     def epg_ids(cls):
-        query = cls.select(cls.epg_id).where(cls.visible == True).distinct()
-        with cls.merged():
+        with cls.overlaid() as (query, c):
+            query = query.select(c['epg_id']).where(c['visible'] == True).distinct()
             return [x[0] for x in query.tuples()]
 
     @classmethod
     def playlist_list(cls, radio=None):
-        query = cls.select(cls).join(Playlist).where(cls.visible == True).order_by(cls.chno.asc(nulls='LAST'), cls.playlist.order, cls.order)
+        with cls.overlaid() as (query, c):
+            query = query.where(c['visible'] == True).order_by(c['chno'].asc(nulls='LAST'), Playlist.order, c['order'])
 
-        if radio is not None:
-            query = query.where(cls.radio == radio)
+            if radio is not None:
+                query = query.where(c['radio'] == radio)
 
-        with cls.merged():
             for channel in query:
                 yield(channel)
 
+    def page_key(self):
+        return [self.chno is None, self.chno or 0, self.playlist.order, self.order, self.slug]
+
     @classmethod
-    def channel_list(cls, radio=None, playlist_id=0, page=1, page_size=0, search=None):
-        query = cls.select(cls).join(Playlist).order_by(cls.chno.asc(nulls='LAST'), cls.playlist.order, cls.order)
+    def channel_list(cls, radio=None, playlist_id=0, page=1, page_size=0, search=None, after=None):
+        with cls.overlaid() as (query, c):
+            ## Must match page_key
+            keys = [c['chno'].is_null(), peewee.fn.COALESCE(c['chno'], 0), Playlist.order, c['order'], cls.slug]
+            query = query.order_by(*keys)
+
+            if radio is not None:
+                query = query.where(c['radio'] == radio)
 
-        if radio is not None:
-            query = query.where(cls.radio == radio)
+            if playlist_id is None:
+                query = query.where(cls.playlist_id.is_null())
+            elif playlist_id:
+                query = query.where(cls.playlist_id == playlist_id)
 
-        if playlist_id is None:
-            query = query.where(cls.playlist_id.is_null())
-        elif playlist_id:
-            query = query.where(cls.playlist_id == playlist_id)
+            if search and len(search) >= 3 and _search_supported():
+                cls._update_search()
+                query = query.where(cls.slug.in_(peewee.SQL('(SELECT slug FROM "{}" WHERE "{}" MATCH ?)'.format(SEARCH_TABLE, SEARCH_TABLE), ['"{}"'.format(search.replace('"', '""'))])))
+            elif search:
+                query = query.where(c['name'].concat(' ').concat(c['url']) ** '%{}%'.format(search))
 
-        if search:
-            query = query.where(cls.name.concat(' ').concat(cls.url) ** '%{}%'.format(search))
+            if after:
+                query = query.where(_keyset(keys, after))
 
-        if page_size > 0:
-            query = query.paginate(page, page_size)
+            if page_size > 0:
+                query = query.limit(page_size) if after else query.paginate(page, page_size)
 
-        with cls.merged():
             for channel in query.prefetch(Playlist):
                 yield(channel)
 
+    @classmethod
+    def _update_search(cls):
+        # Triggers flag the search table as stale whenever channels or overrides change. It's rebuilt on the next search
+        key = '_{}'.format(SEARCH_TABLE)
+        triggers = []
+        for table in (cls, Override):
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                triggers.append(('{}_{}_{}'.format(SEARCH_TABLE, table.table_name(), event.lower()), table.table_name(), event))
+
+        existing = database.db.execute_sql('SELECT COUNT(*) FROM sqlite_master WHERE type = \'trigger\' AND name LIKE ?', ['{}_%'.format(SEARCH_TABLE)]).fetchone()[0]
+        if existing != len(triggers):
+            with database.db.atomic():
+                for name, table_name, event in triggers:
+                    database.db.execute_sql('CREATE TRIGGER IF NOT EXISTS "{}" AFTER {} ON "{}" BEGIN UPDATE "{}" SET value = \'0\' WHERE key = \'{}\' AND value != \'0\'; END'.format(
+                        name, event, table_name, database.KeyStore.table_name(), key))
+                database.KeyStore.set(key=key, value='0')
+
+        if database.KeyStore.exists_or_false(database.KeyStore.key == key, database.KeyStore.value == '1'):
+            return
+
+        start = time.time()
+        with database.db.atomic():
+            with cls.overlaid() as (query, c):
+                sql, params = query.select(cls.slug, c['name'].concat(' ').concat(c['url'])).sql()
+
+            database.db.execute_sql('DELETE FROM "{}"'.format(SEARCH_TABLE))
+            database.db.execute_sql('INSERT INTO "{}" (slug, text) {}'.format(SEARCH_TABLE, sql), params)
+            database.KeyStore.set(key=key, value='1')
+
+        log.debug('Search index rebuilt in {:.2f}s'.format(time.time() - start))
+
+    @classmethod
+    @contextmanager
+    def overlaid(cls):
+        # Yields a channel query with overrides applied by SQLite itself, along with the column expressions to filter / order on.
+        # SQLite builds without JSON1 fall back to writing the overrides into a rolled back transaction
+        fields = cls._meta.sorted_fields
+
+        if not _json_supported():
+            with cls.merged():
+                yield cls.select(cls).join(Playlist), {field.name: field for field in fields}
+            return
+
+        columns = {}
+        for field in fields:
+            if field.name in ('slug', 'playlist', 'custom'):
+                value = field
+            elif field.name in ('attribs', 'properties'):
+                value = peewee.fn.json_patch(field, peewee.fn.COALESCE(getattr(Override, field.name), '{}'))
+            elif field.name == 'modified':
+                value = peewee.Case(None, [(Override.slug.is_null(False) & (cls.custom == False), True)], field)
+            else:
+                path = '$.{}'.format(field.name)
+                value = peewee.Case(None, [(peewee.fn.json_type(Override.fields, path).is_null(False), peewee.fn.json_extract(Override.fields, path))], field)
+
+            columns[field.name] = value
+
+        query = cls.select(*[columns[field.name].alias(field.column_name) for field in fields]) \
+            .join(Playlist).switch(cls) \
+            .join(Override, peewee.JOIN.LEFT_OUTER, on=(Override.slug == cls.slug))
+
+        yield query, columns
+
     @classmethod
     @contextmanager
     def merged(cls):
@@ -588,6 +720,10 @@ class Channel(database.Model):
 
     @classmethod
     def from_playlist(cls, extinf):
+        return Channel(**cls.parse_extinf(extinf))
+
+    @staticmethod
+    def parse_extinf(extinf):
         colon = extinf.find(':', 0)
         comma = extinf.rfind(',', 0)
 
@@ -596,7 +732,7 @@ class Channel(database.Model):
             name = extinf[comma+1:].strip()
 
         attribs = {}
-        for key, value in re.findall('([\w-]+)="([^"]*)"', extinf):
+        for key, value in ATTRIBS_RE.findall(extinf):
             attribs[key.lower()] = value.strip()
 
         is_radio = attribs.pop('radio', 'false').lower() == 'true'
@@ -613,18 +749,29 @@ class Channel(database.Model):
         else:
             groups = []
 
-        channel = Channel(
-            chno = chno,
-            name = name,
-            groups = groups,
-            radio = is_radio,
-            epg_id = attribs.pop('tvg-id', None) or attribs.get('tvg-name') or name,
-            logo = attribs.pop('tvg-logo', None),
-        )
+        return {
+            'chno': chno,
+            'name': name,
+            'groups': groups,
+            'radio': is_radio,
+            'epg_id': attribs.pop('tvg-id', None) or attribs.get('tvg-name') or name,
+            'logo': attribs.pop('tvg-logo', None),
+            'attribs': attribs,
+        }
+
+    @classmethod
+    def insert_rows(cls, rows):
+        # Plain dict rows straight to executemany, skipping model instances and per batch query building
+        if not rows:
+            return
 
-        channel.attribs = attribs
+        fields = cls._meta.sorted_fields
+        defaults = [field.db_value(field.default() if callable(field.default) else field.default) for field in fields]
 
-        return channel
+        sql = 'INSERT INTO "{}" ({}) VALUES ({})'.format(cls._meta.table_name, ', '.join('"{}"'.format(field.column_name) for field in fields), ', '.join('?'*len(fields)))
+        values = [tuple(field.db_value(row[field.name]) if field.name in row else defaults[i] for i, field in enumerate(fields)) for row in rows]
+
+        database.db.cursor().executemany(sql, values)
 
 class Override(database.Model):
     playlist = peewee.ForeignKeyField(Playlist, backref="overrides", on_delete='cascade')
@@ -720,4 +867,37 @@ class Override(database.Model):
     def clean(cls):
         cls.delete().where((cls.fields=={}) & (cls.attribs=={}) & (cls.properties=={}) & (cls.headers=={})).execute()
 
-database.tables.extend([Playlist, EPG, Channel, Override])
+class SourceState(database.Model):
+    key           = peewee.CharField(primary_key=True)
+    etag          = peewee.CharField(null=True)
+    last_modified = peewee.CharField(null=True)
+    content_hash  = peewee.CharField(null=True)
+    context_hash  = peewee.CharField(null=True)
+    epg_urls      = database.JSONField(default=list)
+    start_index   = peewee.IntegerField(default=0)
+    end_index     = peewee.IntegerField(default=0)
+
+    @staticmethod
+    def key_for(source):
+        # Keyed on the row so sources sharing a path keep their own state. Playlist provided EPGs have no row
+        name = source.__class__.__name__.lower()
+        if source.id:
+            return '{}.{}'.format(name, source.id)
+        else:
+            return '{}.url.{}'.format(name, source.path.strip().lower())
+
+    @classmethod
+    def for_sources(cls, sources, prefix):
+        keys = [cls.key_for(source) for source in sources]
+        cls.delete().where(cls.key.startswith(prefix+'.'), cls.key.not_in(keys)).execute()
+        existing = {row.key: row for row in cls.select().where(cls.key.in_(keys))} if keys else {}
+        return [existing.get(key) or cls(key=key) for key in keys]
+
+    def save(self, *args, **kwargs):
+        return type(self).replace(**self.__data__).execute()
+
+database.tables.extend([Playlist, EPG, Channel, Override, SourceState])
+database.indexes.extend([
+    peewee.ModelIndex(Channel, (Channel.playlist, Channel.order), safe=True),
+    peewee.ModelIndex(Channel, (Channel.radio, Channel.chno, Channel.order), safe=True),
+])
@@ -1,4 +1,5 @@
 import os
+import json
 from difflib import SequenceMatcher
 
 from kodi_six import xbmc
@@ -349,14 +350,14 @@ def manager(radio=0, **kwargs):
     return folder
 
 @plugin.route()
-def channels(radio=0, page=1, **kwargs):
+def channels(radio=0, page=1, after=None, **kwargs):
     folder = plugin.Folder(_.ALL_CHANNELS)
 
     radio     = int(radio)
     page      = int(page)
     page_size = settings.getInt('page_size', 0)
 
-    query = Channel.channel_list(radio=radio, page=page, page_size=page_size)
+    query = list(Channel.channel_list(radio=radio, page=page, page_size=page_size, after=json.loads(after) if after else None))
 
     items = _process_channels(query)
     folder.add_items(items)
@@ -364,7 +365,7 @@ def channels(radio=0, page=1, **kwargs):
     if len(items) == page_size:
         folder.add_item(
             label = _(_.NEXT_PAGE, page=page+1, _bold=True),
-            path  = plugin.url_for(channels, radio=radio, page=page+1),
+            path  = plugin.url_for(channels, radio=radio, page=page+1, after=json.dumps(query[-1].page_key())),
         )
 
     return folder
@@ -447,7 +448,7 @@ def edit_channel_value(slug, method, **kwargs):
         gui.refresh()
 
 @plugin.route()
-def search_channel(query=None, radio=0, page=1, **kwargs):
+def search_channel(query=None, radio=0, page=1, after=None, **kwargs):
     radio  = int(radio)
     page   = int(page)
 
@@ -461,7 +462,7 @@ def search_channel(query=None, radio=0, page=1, **kwargs):
     folder = plugin.Folder(_(_.SEARCH_FOR, query=query))
 
     page_size = settings.getInt('page_size', 0)
-    db_query  = Channel.channel_list(radio=radio, page=page, search=query, page_size=page_size)
+    db_query  = list(Channel.channel_list(radio=radio, page=page, search=query, page_size=page_size, after=json.loads(after) if after else None))
 
     items = _process_channels(db_query)
     folder.add_items(items)
@@ -469,13 +470,13 @@ def search_channel(query=None, radio=0, page=1, **kwargs):
     if len(items) == page_size:
         folder.add_item(
             label = _(_.NEXT_PAGE, page=page+1, _bold=True),
-            path  = plugin.url_for(search_channel, query=query, radio=radio, page=page+1),
+            path  = plugin.url_for(search_channel, query=query, radio=radio, page=page+1, after=json.dumps(db_query[-1].page_key())),
         )
 
     return folder
 
 @plugin.route()
-def playlist_channels(playlist_id, radio=0, page=1, **kwargs):
+def playlist_channels(playlist_id, radio=0, page=1, after=None, **kwargs):
     playlist_id = int(playlist_id)
     radio       = int(radio)
     page        = int(page)
@@ -485,7 +486,7 @@ def playlist_channels(playlist_id, radio=0, page=1, **kwargs):
     folder = plugin.Folder(playlist.label)
 
     page_size = settings.getInt('page_size', 0)
-    db_query  = Channel.channel_list(playlist_id=playlist_id, radio=radio, page=page, page_size=page_size)
+    db_query  = list(Channel.channel_list(playlist_id=playlist_id, radio=radio, page=page, page_size=page_size, after=json.loads(after) if after else None))
 
     items = _process_channels(db_query)
     folder.add_items(items)
@@ -493,7 +494,7 @@ def playlist_channels(playlist_id, radio=0, page=1, **kwargs):
     if len(items) == page_size:
         folder.add_item(
             label = _(_.NEXT_PAGE, page=page+1, _bold=True),
-            path  = plugin.url_for(playlist_channels, playlist_id=playlist_id, radio=radio, page=page+1),
+            path  = plugin.url_for(playlist_channels, playlist_id=playlist_id, radio=radio, page=page+1, after=json.dumps(db_query[-1].page_key())),
         )
 
     if playlist.source_type == Playlist.TYPE_CUSTOM:
@@ -1,12 +1,11 @@
 import codecs
 import time
 import re
-from xml.sax.saxutils import escape
 
-import arrow
 from kodi_six import xbmc
 from slyguy import plugin, gui, settings, userdata, signals, inputstream
 from slyguy.exceptions import PluginError
+from slyguy.xmltv import open_xmltv
 
 from .api import API
 from .language import _
@@ -173,18 +172,10 @@ def playlist(output, **kwargs):
 @plugin.merge()
 @plugin.login_required()
 def epg(output, **kwargs):
-    with codecs.open(output, 'w', encoding='utf8') as f:
-        f.write(u'<?xml version="1.0" encoding="utf-8" ?><tv>')
-
+    with open_xmltv(output) as writer:
         for row in api.epg(days=settings.getInt('epg_days', 3)):
             channel = row['Channel']
-
-            f.write(u'<channel id="{}"><display-name>{}</display-name><icon src="{}"/></channel>'.format(
-                channel['Id'], escape(channel['Name']), escape(_get_logo(channel['Logo']))))
+            writer.channel(channel['Id'], name=channel['Name'], icon=_get_logo(channel['Logo']))
 
             for program in row['EpgList']:
-                f.write(u'<programme channel="{}" start="{}" stop="{}"><title>{}</title><desc>{}</desc></programme>'.format(
-                    channel['Id'], arrow.get(program['StartTime']).format('YYYYMMDDHHmmss Z'), arrow.get(program['EndTime']).format('YYYYMMDDHHmmss Z'),
-                        escape(program['Name']), escape(program['Description'])))
-
-        f.write(u'</tv>')
\ No newline at end of file
+                writer.programme(channel['Id'], program['StartTime'], program['EndTime'], program['Name'], desc=program['Description'])
\ No newline at end of file
@@ -1,6 +1,5 @@
 import codecs
 import threading
-from xml.sax.saxutils import escape
 
 import arrow
 from kodi_six import xbmcplugin, xbmc
@@ -10,6 +9,7 @@ from slyguy import plugin, gui, userdata, inputstream, signals, settings
 from slyguy.session import Session
 from slyguy.log import log
 from slyguy.util import gzip_extract
+from slyguy.xmltv import open_xmltv
 
 from .api import API
 from .language import _
@@ -390,33 +390,21 @@ def epg(output, **kwargs):
             log.exception(e)
             log.debug('Failed to get remote epg: {}. Fall back to scraping'.format(epg_url))
 
-    with codecs.open(output, 'w', encoding='utf8') as f:
-        f.write(u'<?xml version="1.0" encoding="utf-8" ?><tv>')
-
+    with open_xmltv(output) as writer:
         def process_data(id, data):
             program_count = 0
             for event in data:
-                channel   = event['channelTag']
-                start     = arrow.get(event['startDateTime']).to('utc')
-                stop      = arrow.get(event['endDateTime']).to('utc')
-                title     = event.get('title')
-                subtitle  = event.get('episodeTitle')
-                series    = event.get('seasonNumber')
-                episode   = event.get('episodeNumber')
-                desc      = event.get('longSynopsis')
-                icon      = event.get('thumbnailImagePaths', {}).get('THUMB')
-
-                icon = u'<icon src="{}"/>'.format(icon) if icon else ''
-                episode = u'<episode-num system="onscreen">S{}E{}</episode-num>'.format(series, episode) if series and episode else ''
-                subtitle = u'<sub-title>{}</sub-title>'.format(escape(subtitle)) if subtitle else ''
-
-                f.write(u'<programme channel="{id}" start="{start}" stop="{stop}"><title>{title}</title>{subtitle}{icon}{episode}<desc>{desc}</desc></programme>'.format(
-                    id=channel, start=start.format('YYYYMMDDHHmmss Z'), stop=stop.format('YYYYMMDDHHmmss Z'), title=escape(title), subtitle=subtitle, episode=episode, icon=icon, desc=escape(desc)))
+                series  = event.get('seasonNumber')
+                episode = event.get('episodeNumber')
+                episode = u'S{}E{}'.format(series, episode) if series and episode else None
+
+                writer.programme(event['channelTag'], event['startDateTime'], event['endDateTime'], event.get('title'), subtitle=event.get('episodeTitle'),
+                    desc=event.get('longSynopsis'), icon=event.get('thumbnailImagePaths', {}).get('THUMB'), episode=episode)
 
         ids = []
         no_events = []
         for row in api.channels():
-            f.write(u'<channel id="{id}"></channel>'.format(id=row['id']))
+            writer.channel(row['id'])
             ids.append(row['id'])
 
             if not row.get('events'):
@@ -484,6 +472,4 @@ def epg(output, **kwargs):
             elif id in no_events:
                 log.debug('Skipped {}: Expected 0 events'.format(id))
             else:
-                raise Exception('Failed {}'.format(id))
-
-        f.write(u'</tv>')
\ No newline at end of file
+                raise Exception('Failed {}'.format(id))
\ No newline at end of file
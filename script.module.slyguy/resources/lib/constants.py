@@ -5,4 +5,15 @@ ADDONS_MD5         = 'https://k.slyguy.xyz/.repo/addons.xml.md5'
 NEWS_CHECK_TIME    = 7200 #2 Hours
 UPDATES_CHECK_TIME = 3600 #1 Hour
 NEWS_MAX_TIME      = 432000 #5 Days
-SERVICE_BUILD_TIME = 3600 #1 Hour
\ No newline at end of file
+SERVICE_BUILD_TIME = 3600 #1 Hour
+
+## PROXY ##
+PROXY_POOL_SIZE     = 30
+PASSTHROUGH_BUFFER  = 256 * 1024
+PASSTHROUGH_BUFFERS = 10
+M3U8_CACHE_SIZE     = 10
+
+PREFETCH_WORKERS    = 3
+PREFETCH_WAIT       = 10 #seconds
+
+PROXY_SERVER_WORKERS = 16
\ No newline at end of file
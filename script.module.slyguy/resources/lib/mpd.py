@@ -0,0 +1,158 @@
+import xml.parsers.expat
+from xml.sax.saxutils import escape
+
+ATTRIB_ESCAPE = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}
+
+## SUPPORT NEW DOLBY FORMAT https://github.com/xbmc/inputstream.adaptive/pull/466
+## SUPPORT EC-3 CHANNEL COUNT https://github.com/xbmc/inputstream.adaptive/pull/618
+SCHEME_SUBS = {
+    'tag:dolby.com,2014:dash:audio_channel_configuration:2011': 'urn:dolby:dash:audio_channel_configuration:2011',
+    'urn:mpeg:mpegB:cicp:ChannelConfiguration': 'urn:mpeg:dash:23003:3:audio_channel_configuration:2011',
+}
+
+class Node(object):
+    __slots__ = ('tag', 'attrib', 'children', 'parent', 'text')
+
+    def __init__(self, tag, attrib=None, parent=None):
+        self.tag = tag
+        self.attrib = attrib if attrib is not None else {}
+        self.children = []
+        self.parent = parent
+        self.text = u''
+
+    def append(self, node):
+        if node.parent is not None:
+            node.parent.remove(node)
+
+        node.parent = self
+        self.children.append(node)
+
+    def remove(self, node):
+        self.children.remove(node)
+        node.parent = None
+
+    def iter(self):
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def has_descendant(self, tag):
+        for node in self.iter():
+            if node is not self and node.tag == tag:
+                return True
+
+        return False
+
+    def _write(self, write):
+        write(u'<')
+        write(self.tag)
+
+        for key in self.attrib:
+            write(u' {}="{}"'.format(key, escape(self.attrib[key], ATTRIB_ESCAPE)))
+
+        if not self.children and not self.text:
+            write(u'/>')
+            return
+
+        write(u'>')
+
+        if self.text:
+            write(escape(self.text))
+
+        for child in self.children:
+            child._write(write)
+
+        write(u'</{}>'.format(self.tag))
+
+    def toxml(self, encoding='utf-8'):
+        parts = [u'<?xml version="1.0" encoding="{}"?>'.format(encoding)]
+        self._write(parts.append)
+        return u''.join(parts).encode(encoding)
+
+class TreeBuilder(object):
+    def __init__(self):
+        self.root = None
+        self._node = None
+        self._text = []
+
+        self._parser = xml.parsers.expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start_element
+        self._parser.EndElementHandler = self._end_element
+        self._parser.CharacterDataHandler = self._char_data
+
+    def _flush_text(self):
+        if self._text:
+            self._node.text += u''.join(self._text)
+            self._text = []
+
+    def _start_element(self, name, attrs):
+        if 'schemeIdUri' in attrs:
+            attrs['schemeIdUri'] = SCHEME_SUBS.get(attrs['schemeIdUri'], attrs['schemeIdUri'])
+
+        if self._node is None:
+            node = self.root = Node(name, attrs)
+        else:
+            self._flush_text()
+            node = Node(name, attrs, self._node)
+            self._node.children.append(node)
+
+        self._node = node
+
+    def _end_element(self, name):
+        self._flush_text()
+
+        node = self._node
+        if node.children and not node.text.strip():
+            node.text = u''
+
+        self._node = node.parent
+
+    def _char_data(self, data):
+        if self._node is not None:
+            self._text.append(data)
+
+    def parse(self, data):
+        self._parser.Parse(data, True)
+        return self.root
+
+def parse(data):
+    builder = TreeBuilder()
+    builder.parse(data)
+    return builder.root
+
+class SiblingIndex(object):
+    # Replaces the recursive sibling scan with a per-parent lookup (SegmentList can hold thousands of SegmentURL)
+    def __init__(self):
+        self._cache = {}
+
+    def _children(self, parent, tag):
+        key = (id(parent), tag)
+        if key not in self._cache:
+            self._cache[key] = [x for x in parent.children if x.tag == tag]
+
+        return self._cache[key]
+
+    def get_parent_node(self, node, tag, levels=99):
+        while node.parent is not None and levels > 0:
+            for sibling in self._children(node.parent, tag):
+                if sibling is not node:
+                    return sibling
+
+            node = node.parent
+            levels -= 1
+
+        return None
+
+    def remove(self, node):
+        parent = node.parent
+        if parent is None:
+            return
+
+        key = (id(parent), node.tag)
+        if key in self._cache:
+            self._cache[key].remove(node)
+
+        parent.remove(node)
@@ -0,0 +1,187 @@
+import re
+import threading
+from collections import OrderedDict
+
+from six.moves import queue
+from six.moves.urllib.parse import urljoin
+
+from slyguy.log import log
+
+TEMPLATE_RE = re.compile(r'\$(RepresentationID|Bandwidth|Number)(?:%0\d+d)?\$')
+
+def _template_regex(template):
+    template = template.split('?')[0].split('/')[-1]
+    if '$Time' in template or template.count('$Number') != 1:
+        return None
+
+    pattern = ''
+    pos = 0
+    for match in TEMPLATE_RE.finditer(template):
+        pattern += re.escape(template[pos:match.start()])
+        pattern += r'(\d+)' if match.group(1) == 'Number' else r'[^/]+'
+        pos = match.end()
+
+    pattern += re.escape(template[pos:])
+    return re.compile('/' + pattern + '$')
+
+class Prefetcher(object):
+    def __init__(self, session, workers, segments, max_bytes):
+        self._session = session
+        self._segments = segments
+        self._max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._size = 0
+        self._inflight = {}
+        self._playlists = {}
+        self._index = {}
+        self._templates = []
+        self._stopped = False
+
+        self.hits = 0
+        self.misses = 0
+        self.fetched_bytes = 0
+        self.wasted_bytes = 0
+
+        self._queue = queue.Queue(maxsize=workers*segments*2)
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def add_playlist(self, playlist_url, m3u8):
+        if '#EXT-X-BYTERANGE' in m3u8:
+            return
+
+        segments = [urljoin(playlist_url, line.strip()) for line in m3u8.split('\n') if line.strip() and not line.startswith('#')]
+
+        with self._lock:
+            for url in self._playlists.get(playlist_url, []):
+                self._index.pop(url, None)
+
+            self._playlists[playlist_url] = segments
+            for i, url in enumerate(segments):
+                self._index[url] = (segments, i)
+
+    def add_mpd(self, mpd):
+        ## Live segments past the edge don't exist yet
+        if 'type="dynamic"' in mpd:
+            return
+
+        templates = []
+        for template in re.findall(r'\smedia="([^"]+)"', mpd):
+            regex = _template_regex(template)
+            if regex and regex.pattern not in [x.pattern for x in templates]:
+                templates.append(regex)
+
+        with self._lock:
+            self._templates = templates
+
+    def _next_urls(self, url):
+        if url in self._index:
+            segments, i = self._index[url]
+            return segments[i+1:i+1+self._segments]
+
+        path = url.split('?')[0]
+        for regex in self._templates:
+            match = regex.search(path)
+            if not match:
+                continue
+
+            number = match.group(1)
+            start, end = match.start(1), match.end(1)
+            return [url[:start] + str(int(number)+i).zfill(len(number)) + url[end:] for i in range(1, self._segments+1)]
+
+        return []
+
+    def get(self, url, timeout):
+        with self._lock:
+            event = self._inflight.get(url)
+
+        if event:
+            event.wait(timeout)
+
+        with self._lock:
+            item = self._cache.pop(url, None)
+            if item:
+                self._size -= len(item[2])
+                self.hits += 1
+            elif event or self._next_urls(url):
+                self.misses += 1
+
+        return item
+
+    def schedule(self, url, headers, verify):
+        with self._lock:
+            urls = [x for x in self._next_urls(url) if x not in self._cache and x not in self._inflight]
+
+            for next_url in urls:
+                try:
+                    self._queue.put_nowait((next_url, headers, verify))
+                except queue.Full:
+                    break
+                else:
+                    self._inflight[next_url] = threading.Event()
+
+    def _worker(self):
+        while True:
+            task = self._queue.get()
+            if task is None or self._stopped:
+                break
+
+            url, headers, verify = task
+            try:
+                # Same as the proxy's own requests - a redirect is not cached, the live request then passes it through
+                resp = self._session.get(url, headers=headers, verify=verify, allow_redirects=False)
+                if resp.status_code == 200 and len(resp.content) <= self._max_bytes / 2:
+                    self._store(url, resp)
+            except Exception as e:
+                log.debug('Prefetch failed: {} ({})'.format(url, e))
+            finally:
+                with self._lock:
+                    event = self._inflight.pop(url, None)
+
+                if event:
+                    event.set()
+
+    def _store(self, url, resp):
+        content = resp.content
+
+        with self._lock:
+            self.fetched_bytes += len(content)
+            self._cache[url] = (resp.status_code, dict(resp.headers), content)
+            self._size += len(content)
+
+            while self._size > self._max_bytes:
+                key, item = self._cache.popitem(last=False)
+                self._size -= len(item[2])
+                self.wasted_bytes += len(item[2])
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(float(self.hits) / requests, 2) if requests else 0,
+                'fetched_bytes': self.fetched_bytes,
+                'wasted_bytes': self.wasted_bytes + self._size,
+            }
+
+    def stop(self):
+        self._stopped = True
+
+        with self._lock:
+            for event in self._inflight.values():
+                event.set()
+
+        for thread in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+
+        log.debug('Prefetch stats: {}'.format(self.stats()))
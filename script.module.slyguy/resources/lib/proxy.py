@@ -1,15 +1,15 @@
 import threading
+import errno
 import os
 import re
 import time
 import json
 
 from xml.dom.minidom import parseString
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from functools import cmp_to_key
 
-from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-from six.moves.socketserver import ThreadingMixIn
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler
 from six.moves.urllib.parse import urlparse, urljoin, unquote, parse_qsl, quote_plus
 from kodi_six import xbmc, xbmcvfs
 from requests import ConnectionError
@@ -21,10 +21,13 @@ from slyguy.util import check_port, remove_file, get_kodi_string, set_kodi_strin
 from slyguy.plugin import failed_playback
 from slyguy.exceptions import Exit
 from slyguy.session import RawSession
+from slyguy.server import create_server
 from slyguy.language import _
 from slyguy.router import add_url_args
 
 from .constants import *
+from . import mpd as mpd_tree
+from .prefetch import Prefetcher
 
 #ADDON_DEV = True
 
@@ -57,6 +60,19 @@ PROXY_GLOBAL = {
     'session': {},
 }
 
+MEDIA_SEQUENCE_RE = re.compile(r'#EXT-X-MEDIA-SEQUENCE:\s*(\d+)', re.I)
+ABS_URI_RE = re.compile(r'URI="/', re.I)
+PROXY_URL_RE = re.compile(r'(https?)://', re.I)
+
+def _rewrite_m3u8_line(line, base_url):
+    if line.startswith('/'):
+        line = base_url + line[1:]
+
+    line = ABS_URI_RE.sub(r'URI="{}'.format(base_url), line)
+
+    ## Convert to proxy paths
+    return PROXY_URL_RE.sub(r'{}\1://'.format(PROXY_PATH), line)
+
 class RequestHandler(BaseHTTPRequestHandler):
     def __init__(self, request, client_address, server):
         try:
@@ -90,6 +106,10 @@ class RequestHandler(BaseHTTPRequestHandler):
         try:
             proxy_data = json.loads(get_kodi_string('_slyguy_quality'))
             if self._session.get('session_id') != proxy_data['session_id']:
+                if self._session.get('session'):
+                    log.debug('Proxy pool stats: {}'.format(self._session['session'].pool_stats()))
+                if self._session.get('prefetch'):
+                    self._session['prefetch'].stop()
                 self._session = {}
 
             self._session.update(proxy_data)
@@ -326,6 +346,229 @@ class RequestHandler(BaseHTTPRequestHandler):
         data = response.stream.content.decode('utf8')
         data = self._manifest_middleware(data)
 
+        if self._session.get('prefetch'):
+            self._session['prefetch'].add_mpd(data)
+
+        ## Both parsers stop before quality selection, so falling back can't prompt twice
+        try:
+            streams, finish = self._parse_dash_expat(response, data)
+        except Exit:
+            raise
+        except Exception as e:
+            log.debug('Dash expat parse failed. Falling back to minidom')
+            log.exception(e)
+            streams, finish = self._parse_dash_minidom(response, data)
+
+        mpd = finish(self._quality_select(streams))
+
+        if ADDON_DEV:
+            mpd = parseString(mpd).toprettyxml(encoding='utf-8')
+            mpd = b"\n".join([ll.rstrip() for ll in mpd.splitlines() if ll.strip()])
+
+            log.debug('Time taken: {}'.format(time.time() - start))
+            with open(xbmc.translatePath('special://temp/out.mpd'), 'wb') as f:
+                f.write(mpd)
+
+        response.stream.content = mpd
+
+    def _parse_dash_expat(self, response, data):
+        root = mpd_tree.parse(data.encode('utf8'))
+        if root is None or root.tag != 'MPD':
+            raise Exception('Invalid mpd')
+
+        ## Remove publishTime PR: https://github.com/xbmc/inputstream.adaptive/pull/564
+        if root.attrib.pop('publishTime', None) is not None:
+            log.debug('Dash Fix: publishTime removed')
+
+        ## SORT ADAPTION SETS BY BITRATE ##
+        video_sets = []
+        audio_sets = []
+        lang_adap_sets = []
+        streams, all_streams = [], []
+        adap_parent = None
+
+        default_language = self._session.get('default_language', '')
+
+        for period_index, period in enumerate([x for x in root.children if x.tag == 'Period']):
+            rep_index = 0
+            for adap_set in [x for x in period.children if x.tag == 'AdaptationSet']:
+                adap_parent = adap_set.parent
+
+                highest_bandwidth = 0
+                is_video = False
+                is_trick = False
+
+                for stream in [x for x in adap_set.children if x.tag == 'Representation']:
+                    ## Make sure Representation are last in adaptionset
+                    adap_set.append(stream)
+                    #######
+
+                    attribs = dict(adap_set.attrib)
+                    attribs.update(stream.attrib)
+
+                    if default_language and 'audio' in attribs.get('mimeType', '') and (attribs.get('lang') or '').lower() == default_language.lower() and adap_set not in lang_adap_sets:
+                        lang_adap_sets.append(adap_set)
+
+                    bandwidth = 0
+                    if 'bandwidth' in attribs:
+                        bandwidth = int(attribs['bandwidth'])
+                        if bandwidth > highest_bandwidth:
+                            highest_bandwidth = bandwidth
+
+                    if 'maxPlayoutRate' in attribs:
+                        is_trick = True
+
+                    if 'video' in attribs.get('mimeType', '') and not is_trick:
+                        is_video = True
+
+                        resolution = ''
+                        if 'width' in attribs and 'height' in attribs:
+                            resolution = '{}x{}'.format(attribs['width'], attribs['height'])
+
+                        frame_rate = ''
+                        if 'frameRate'in attribs:
+                            frame_rate = attribs['frameRate']
+                            try:
+                                if '/' in str(frame_rate):
+                                    split = frame_rate.split('/')
+                                    frame_rate = float(split[0]) / float(split[1])
+                            except:
+                                frame_rate = ''
+
+                        codecs = [x for x in attribs.get('codecs', '').split(',') if x]
+                        stream = {'bandwidth': bandwidth, 'resolution': resolution, 'frame_rate': frame_rate, 'codecs': codecs, 'rep_index': rep_index, 'elem': stream}
+                        all_streams.append(stream)
+                        rep_index += 1
+
+                        if period_index == 0:
+                            streams.append(stream)
+
+                adap_parent.remove(adap_set)
+
+                if is_trick:
+                    continue
+
+                if is_video:
+                    video_sets.append([highest_bandwidth, adap_set, adap_parent])
+                else:
+                    audio_sets.append([highest_bandwidth, adap_set, adap_parent])
+
+        video_sets.sort(key=lambda  x: x[0], reverse=True)
+        audio_sets.sort(key=lambda  x: x[0], reverse=True)
+
+        for elem in video_sets:
+            elem[2].append(elem[1])
+
+        for elem in audio_sets:
+            elem[2].append(elem[1])
+
+        ## Insert subtitles
+        if adap_parent:
+            for idx, subtitle in enumerate(self._session.get('subtitles') or []):
+                elem = mpd_tree.Node('AdaptationSet', {'mimeType': subtitle[0], 'lang': subtitle[1], 'id': 'caption_{}'.format(idx)})
+                elem2 = mpd_tree.Node('Representation', {'id': 'caption_rep_{}'.format(idx)})
+
+                if 'ttml' in subtitle[0]:
+                    elem2.attrib['codecs'] = 'ttml'
+
+                elem3 = mpd_tree.Node('BaseURL')
+                elem3.text = subtitle[2]
+
+                elem2.append(elem3)
+                elem.append(elem2)
+                adap_parent.append(elem)
+        ##################
+
+        ## Single walk of the restructured tree (document order)
+        tags = defaultdict(list)
+        for elem in root.iter():
+            tags[elem.tag].append(elem)
+
+        ## Set default languae
+        if lang_adap_sets:
+            for elem in tags['Role']:
+                if elem.attrib.get('schemeIdUri') == 'urn:mpeg:dash:role:2011':
+                    elem.parent.remove(elem)
+
+            for adap_set in lang_adap_sets:
+                adap_set.append(mpd_tree.Node('Role', {'schemeIdUri': 'urn:mpeg:dash:role:2011', 'value': 'main'}))
+                log.debug('default language set to: {}'.format(default_language))
+        #############
+
+        ## Convert BaseURLS
+        base_url_parents = set()
+        for elem in tags['BaseURL']:
+            url = elem.text
+
+            if id(elem.parent) in base_url_parents:
+                log.debug('Non-1st BaseURL removed: {}'.format(url))
+                elem.parent.remove(elem)
+                continue
+
+            if url.startswith('/'):
+                url = urljoin(response.url, url)
+
+            if '://' in url:
+                elem.text = PROXY_PATH + url
+
+            base_url_parents.add(id(elem.parent))
+        ################
+
+        ## Convert to proxy paths
+        index = mpd_tree.SiblingIndex()
+
+        for e in tags['SegmentTemplate'] + tags['SegmentURL']:
+            def process_attrib(attrib):
+                if attrib not in e.attrib:
+                    return
+
+                url = e.attrib[attrib]
+                if '://' in url:
+                    e.attrib[attrib] = PROXY_PATH + url
+                else:
+                    ## Fixed with https://github.com/xbmc/inputstream.adaptive/pull/606
+                    base_url = index.get_parent_node(e, 'BaseURL')
+                    if base_url and not base_url.text.endswith('/'):
+                        base_url.text = base_url.text + '/'
+                        log.debug('Dash Fix: base_url / fixed')
+
+                    # Fixed with https://github.com/xbmc/inputstream.adaptive/pull/668
+                    parent_template = index.get_parent_node(e, 'SegmentTemplate', levels=2)
+                    if parent_template:
+                        for key in parent_template.attrib:
+                            if key not in e.attrib:
+                                e.attrib[key] = parent_template.attrib[key]
+
+                        index.remove(parent_template)
+                        log.debug('Dash Fix: Double SegmentTemplate removed')
+
+            process_attrib('initialization')
+            process_attrib('media')
+
+            ## Remove presentationTimeOffset PR: https://github.com/xbmc/inputstream.adaptive/pull/564/
+            if e.attrib.pop('presentationTimeOffset', None) is not None:
+                log.debug('Dash Fix: presentationTimeOffset removed')
+        ###############
+
+        def finish(selected):
+            ## Get selected quality
+            if selected:
+                for stream in all_streams:
+                    if stream['rep_index'] != selected['rep_index'] and stream['elem'].parent is not None:
+                        stream['elem'].parent.remove(stream['elem'])
+            #################
+
+            ## Remove empty adaption sets
+            for adap_set in tags['AdaptationSet']:
+                if adap_set.parent is not None and not adap_set.has_descendant('Representation'):
+                    adap_set.parent.remove(adap_set)
+            #################
+
+            return root.toxml(encoding='utf-8')
+
+        return streams, finish
+
+    def _parse_dash_minidom(self, response, data):
         ## SUPPORT NEW DOLBY FORMAT https://github.com/xbmc/inputstream.adaptive/pull/466
         data = data.replace('tag:dolby.com,2014:dash:audio_channel_configuration:2011', 'urn:dolby:dash:audio_channel_configuration:2011')
         ## SUPPORT EC-3 CHANNEL COUNT https://github.com/xbmc/inputstream.adaptive/pull/618
@@ -532,31 +775,23 @@ class RequestHandler(BaseHTTPRequestHandler):
                 log.debug('Dash Fix: presentationTimeOffset removed')
         ###############
 
-        ## Get selected quality
-        selected = self._quality_select(streams)
-        if selected:
-            for stream in all_streams:
-                if stream['rep_index'] != selected['rep_index']:
-                    stream['elem'].parentNode.removeChild(stream['elem'])
-        #################
+        def finish(selected):
+            ## Get selected quality
+            if selected:
+                for stream in all_streams:
+                    if stream['rep_index'] != selected['rep_index']:
+                        stream['elem'].parentNode.removeChild(stream['elem'])
+            #################
 
-        ## Remove empty adaption sets
-        for adap_set in root.getElementsByTagName('AdaptationSet'):
-            if not adap_set.getElementsByTagName('Representation'):
-                adap_set.parentNode.removeChild(adap_set)
-        #################
+            ## Remove empty adaption sets
+            for adap_set in root.getElementsByTagName('AdaptationSet'):
+                if not adap_set.getElementsByTagName('Representation'):
+                    adap_set.parentNode.removeChild(adap_set)
+            #################
 
-        if ADDON_DEV:
-            mpd = root.toprettyxml(encoding='utf-8')
-            mpd = b"\n".join([ll.rstrip() for ll in mpd.splitlines() if ll.strip()])
+            return root.toxml(encoding='utf-8')
 
-            log.debug('Time taken: {}'.format(time.time() - start))
-            with open(xbmc.translatePath('special://temp/out.mpd'), 'wb') as f:
-                f.write(mpd)
-        else:
-            mpd = root.toxml(encoding='utf-8')
-
-        response.stream.content = mpd
+        return streams, finish
 
     def _parse_m3u8_master(self, m3u8, master_url):
         def _process_media(line):
@@ -725,17 +960,16 @@ class RequestHandler(BaseHTTPRequestHandler):
             with open(xbmc.translatePath('special://temp/'+file_name+'-in.m3u8'), 'wb') as f:
                 f.write(_m3u8)
 
+        base_url = urljoin(response.url, '/')
+
         if is_master:
             m3u8 = self._manifest_middleware(m3u8)
             m3u8 = self._parse_m3u8_master(m3u8, response.url)
-
-        base_url = urljoin(response.url, '/')
-
-        m3u8 = re.sub(r'^/', r'{}'.format(base_url), m3u8, flags=re.I|re.M)
-        m3u8 = re.sub(r'URI="/', r'URI="{}'.format(base_url), m3u8, flags=re.I|re.M)
-
-        ## Convert to proxy paths
-        m3u8 = re.sub(r'(https?)://', r'{}\1://'.format(PROXY_PATH), m3u8, flags=re.I)
+            m3u8 = '\n'.join([_rewrite_m3u8_line(line, base_url) for line in m3u8.split('\n')])
+        else:
+            if self._session.get('prefetch'):
+                self._session['prefetch'].add_playlist(response.url, m3u8)
+            m3u8 = self._rewrite_m3u8_cached(response.url, m3u8, base_url)
 
         m3u8 = m3u8.encode('utf8')
 
@@ -747,6 +981,53 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         response.stream.content = m3u8
 
+    def _rewrite_m3u8_cached(self, url, m3u8, base_url):
+        ## Only the most recently used playlists are kept (each variant / live refresh url is its own entry)
+        cache = self._session.setdefault('m3u8_cache', OrderedDict())
+        cached = cache.pop(url, None)
+        if cached:
+            cache[url] = cached
+
+        match = MEDIA_SEQUENCE_RE.search(m3u8)
+        media_sequence = int(match.group(1)) if match else 0
+
+        if cached and (cached['base_url'] != base_url or media_sequence < cached['media_sequence']):
+            log.debug('M3U8 Cache: reset for {}'.format(url))
+            cached = None
+
+        if not cached:
+            prev_lines = {}
+        elif m3u8 == cached['raw']:
+            return cached['output']
+        elif cached['raw'].endswith('\n') and m3u8.startswith(cached['raw']):
+            ## Growing playlist (EVENT / VOD) - only rewrite the appended lines
+            delta = m3u8[len(cached['raw']):]
+            output = cached['output'] + '\n'.join([_rewrite_m3u8_line(line, base_url) for line in delta.split('\n')])
+            cached.update({'raw': m3u8, 'output': output, 'media_sequence': media_sequence})
+            return output
+        else:
+            prev_lines = cached['lines']
+
+        ## Sliding window - lines still in the window are reused from the last refresh
+        lines = {}
+        output = []
+        for line in m3u8.split('\n'):
+            new_line = lines.get(line)
+            if new_line is None:
+                new_line = prev_lines.get(line)
+                if new_line is None:
+                    new_line = _rewrite_m3u8_line(line, base_url)
+                lines[line] = new_line
+
+            output.append(new_line)
+
+        output = '\n'.join(output)
+        cache[url] = {'raw': m3u8, 'output': output, 'lines': lines, 'base_url': base_url, 'media_sequence': media_sequence}
+        while len(cache) > M3U8_CACHE_SIZE:
+            cache.popitem(last=False)
+
+        return output
+
     def _proxy_request(self, method, url):
         self._session['redirecting'] = False
 
@@ -758,9 +1039,7 @@ class RequestHandler(BaseHTTPRequestHandler):
             if os.path.exists(url):
                 response.ok = True
                 response.status_code = 200
-                with open(url, 'rb') as f:
-                    response.stream.content = f.read()
-                if not ADDON_DEV: remove_file(url)
+                response.stream = ResponseStream(response, path=url)
             else:
                 response.ok = False
                 response.status_code = 500
@@ -774,8 +1053,12 @@ class RequestHandler(BaseHTTPRequestHandler):
                 f.write(self._post_data)
 
         if not self._session.get('session'):
-            self._session['session'] = RawSession()
+            self._session['session'] = RawSession(pool_size=PROXY_POOL_SIZE)
             self._session['session'].set_dns_rewrites(self._session.get('dns_rewrites', []))
+
+            if settings.getBool('proxy_prefetch', False):
+                self._session['prefetch'] = Prefetcher(self._session['session'], PREFETCH_WORKERS,
+                    segments=settings.getInt('proxy_prefetch_segments', 2), max_bytes=settings.getInt('proxy_prefetch_size', 64)*1024*1024)
         else:
             self._session['session'].headers.clear()
             #self._session['session'].cookies.clear() #lets handle cookies in session
@@ -783,8 +1066,15 @@ class RequestHandler(BaseHTTPRequestHandler):
         ## Fix any double // in url
         url = fix_url(url)
 
+        prefetch = self._session.get('prefetch')
+        if prefetch and method == 'GET' and 'range' not in self._headers:
+            item = prefetch.get(url, timeout=PREFETCH_WAIT)
+            prefetch.schedule(url, dict(self._headers), verify=self._session.get('verify_ssl', True))
+            if item:
+                return self._prefetched_response(url, item)
+
         retries = 3
-        # some reason we get connection errors every so often when using a session. something to do with the socket
+        # idle sockets are closed by the pool before servers drop them, but a server can still close a keep-alive socket early
         for i in range(retries):
             try:
                 response = self._session['session'].request(method=method, url=url, headers=self._headers, data=self._post_data, allow_redirects=False, verify=self._session.get('verify_ssl', True), stream=True)
@@ -835,6 +1125,24 @@ class RequestHandler(BaseHTTPRequestHandler):
 
         return response
 
+    def _prefetched_response(self, url, item):
+        status_code, headers, content = item
+
+        response = Response()
+        response.ok = True
+        response.url = url
+        response.status_code = status_code
+        response.headers = {}
+        for header in headers:
+            if header.lower() not in REMOVE_OUT_HEADERS and header.lower() != 'set-cookie':
+                response.headers[header.lower()] = headers[header]
+
+        response.stream = ResponseStream(response)
+        response.stream.content = content
+
+        log.debug('GET OUT: {} ({} prefetched)'.format(url, status_code))
+        return response
+
     def _output_headers(self, response):
         self.send_response(response.status_code)
 
@@ -847,11 +1155,14 @@ class RequestHandler(BaseHTTPRequestHandler):
     def _output_response(self, response):
         self._output_headers(response)
 
-        for chunk in response.stream.iter_content():
-            try:
-                self.wfile.write(chunk)
-            except Exception as e:
-                break
+        try:
+            response.stream.send(self.wfile, self.connection)
+        except Exception as e:
+            # player closing the connection mid segment is normal (seeking / stopping)
+            if getattr(e, 'errno', None) not in CLIENT_DISCONNECT_ERRNOS:
+                log.exception(e)
+        finally:
+            response.stream.close()
 
     def do_HEAD(self):
         url = self._get_url()
@@ -871,15 +1182,26 @@ class RequestHandler(BaseHTTPRequestHandler):
 class Response(object):
     pass
 
+BUFFERS = []
+CLIENT_DISCONNECT_ERRNOS = (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+
 class ResponseStream(object):
-    def __init__(self, response):
+    def __init__(self, response, path=None):
         self._response = response
         self._bytes = None
+        self._path = path
+
+        if self._path:
+            self._response.headers['content-length'] = str(os.path.getsize(self._path))
 
     @property
     def content(self):
         if not self._bytes:
-            self.content = self._response.content
+            if self._path:
+                with open(self._path, 'rb') as f:
+                    self.content = f.read()
+            else:
+                self.content = self._response.content
 
         return self._bytes
 
@@ -908,8 +1230,69 @@ class ResponseStream(object):
 
                 yield chunk
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    daemon_threads = True
+    def send(self, wfile, sock):
+        if self._bytes is not None:
+            wfile.write(self._bytes)
+        elif self._path:
+            self._send_file(wfile, sock)
+        else:
+            self._passthrough(wfile)
+
+    def _send_file(self, wfile, sock):
+        with open(self._path, 'rb') as f:
+            if hasattr(sock, 'sendfile'):
+                sock.sendfile(f)
+                return
+
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                wfile.write(chunk)
+
+    def _passthrough(self, wfile):
+        raw = self._response.raw
+        fp = getattr(raw, '_fp', None)
+
+        # Python 2 httplib responses have no readinto
+        if not hasattr(fp, 'readinto'):
+            for chunk in self.iter_content():
+                wfile.write(chunk)
+            return
+
+        # Body is passed through as-is (requests reads raw with decode_content=False)
+        try:
+            buf = BUFFERS.pop()
+        except IndexError:
+            buf = bytearray(PASSTHROUGH_BUFFER)
+
+        view = memoryview(buf)
+        try:
+            while True:
+                size = fp.readinto(buf)
+                if not size:
+                    break
+
+                wfile.write(view[:size])
+        except:
+            raw.close()
+            raise
+        finally:
+            view.release()
+            if len(BUFFERS) < PASSTHROUGH_BUFFERS:
+                BUFFERS.append(buf)
+
+        raw.release_conn()
+
+    def close(self):
+        if self._path and not ADDON_DEV:
+            remove_file(self._path)
+
+        raw = getattr(self._response, 'raw', None)
+        if raw is not None and not raw.closed:
+            raw.close()
+            raw.release_conn()
 
 class Proxy(object):
     started = False
@@ -918,7 +1301,7 @@ class Proxy(object):
         if self.started:
             return
 
-        self._server = ThreadedHTTPServer((HOST, PORT), RequestHandler)
+        self._server = create_server((HOST, PORT), RequestHandler, workers=PROXY_SERVER_WORKERS)
         self._server.allow_reuse_address = True
         self._httpd_thread = threading.Thread(target=self._server.serve_forever)
         self._httpd_thread.start()
@@ -0,0 +1,5 @@
+import os
+
+if os.environ.get('SLYGUY_IMPORT_TIME'):
+    from . import import_timer
+    import_timer.install()
@@ -1,10 +1,13 @@
-from time import time
+import json
+import threading
+from time import time, sleep
 from functools import wraps
 
 import peewee
+from six.moves import cPickle
 
 from . import database, settings, signals, gui, router
-from .constants import CACHE_TABLENAME, CACHE_EXPIRY, CACHE_CHECKSUM, CACHE_CLEAN_INTERVAL, CACHE_CLEAN_KEY, ROUTE_CLEAR_CACHE
+from .constants import CACHE_TABLENAME, CACHE_EXPIRY, CACHE_CHECKSUM, CACHE_CLEAN_INTERVAL, CACHE_CLEAN_KEY, CACHE_STATS_KEY, CACHE_MAX_SIZE, CACHE_MAX_ROWS, CACHE_LOCK_TABLENAME, CACHE_LOCK_TIMEOUT, CACHE_LOCK_POLL, CACHE_REFRESH_WAIT, ROUTE_CLEAR_CACHE, ROUTE_CACHE_STATS
 from .util import hash_6
 from .log import log
 from .language import _
@@ -14,12 +17,36 @@ funcs   = []
 class Cache(database.Model):
     checksum = CACHE_CHECKSUM
 
+    key      = database.HashField(unique=True)
+    value    = peewee.BlobField()
+    expires  = peewee.IntegerField()
+    accessed = peewee.IntegerField(index=True)
+    size     = peewee.IntegerField()
+
+    class Meta:
+        table_name = CACHE_TABLENAME
+
+class CacheLock(database.Model):
     key     = database.HashField(unique=True)
-    value   = database.PickleField()
     expires = peewee.IntegerField()
 
     class Meta:
-        table_name = CACHE_TABLENAME
+        table_name = CACHE_LOCK_TABLENAME
+
+class Stats(object):
+    hits      = 0
+    misses    = 0
+    evictions = 0
+    changed   = False
+    accessed  = set()
+    saved     = time()
+
+stats = Stats()
+
+refreshing = set()
+pending = []
+refresh_lock = threading.Lock()
+key_locks = {}
 
 def enabled():
     return settings.getBool('use_cache', True)
@@ -58,8 +85,102 @@ def _build_key(func_name, *args, **kwargs):
 
     return hash_6(key)
 
+def _key_lock(key):
+    with refresh_lock:
+        if key not in key_locks:
+            key_locks[key] = threading.Lock()
+
+        return key_locks[key]
+
+def _is_fresh(key, min_expires):
+    # expires is an integer column, so compare against whole seconds
+    return Cache.select().where(Cache.key == key, Cache.expires > int(max(min_expires, time()))).exists()
+
+def _acquire(key, min_expires):
+    # row lock shared by every process using this add-on's db. returns False once another process has filled the key
+    deadline = time() + CACHE_LOCK_TIMEOUT
+
+    while time() < deadline:
+        try:
+            CacheLock.insert(key=key, expires=int(time() + CACHE_LOCK_TIMEOUT)).execute()
+            return True
+        except peewee.IntegrityError:
+            pass
+
+        if _is_fresh(key, min_expires):
+            return False
+
+        CacheLock.delete_where(CacheLock.key == key, CacheLock.expires < int(time()))
+        sleep(CACHE_LOCK_POLL)
+
+    log.debug('Cache: lock wait timed out for {}'.format(key))
+    return False
+
+def _single_flight(key, func, expires, min_expires=0):
+    with _key_lock(key):
+        locked = False
+        try:
+            if enabled():
+                if not _is_fresh(key, min_expires):
+                    locked = _acquire(key, min_expires)
+
+                # may have been filled by another process just before we got the lock
+                if _is_fresh(key, min_expires):
+                    row = _get_row(key)
+                    if row:
+                        return row[0]
+
+            value = func()
+            if value != None:
+                set(key, value, expires)
+
+            return value
+        finally:
+            if locked:
+                CacheLock.delete_where(CacheLock.key == key)
+
+def _refresh(key, f, args, kwargs, expires, stale_ttl):
+    with refresh_lock:
+        if key in refreshing:
+            return
+
+        refreshing.add(key)
+
+    log('Cache Stale: {}'.format(key))
+    pending.append((key, f, args, kwargs, expires, stale_ttl))
+
+@signals.on(signals.ON_CLOSE, first=True)
+def run_refreshes():
+    # Stale rows are refreshed once the route has finished (provider API objects are not thread safe) and before the db is closed
+    if not pending:
+        return
+
+    jobs = pending[:]
+    del pending[:]
+
+    def worker():
+        for key, f, args, kwargs, expires, stale_ttl in jobs:
+            try:
+                with database.db.connection_context():
+                    _single_flight(key, lambda: f(*args, **kwargs), expires, min_expires=time() + stale_ttl)
+            except Exception as e:
+                log.debug('Cache: background refresh of {} failed ({})'.format(key, e))
+            finally:
+                with refresh_lock:
+                    refreshing.discard(key)
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    thread.join(CACHE_REFRESH_WAIT)
+    if thread.is_alive():
+        log.debug('Cache: background refresh still running after {}s'.format(CACHE_REFRESH_WAIT))
+
 def cached(*args, **kwargs):
-    def decorator(f, expires=CACHE_EXPIRY, key=None):
+    def decorator(f, expires=CACHE_EXPIRY, key=None, stale_ttl=None):
+        # with stale_ttl, rows are kept for expires + stale_ttl and a stale row is returned while it refreshes in the background
+        stale_ttl = stale_ttl or 0
+
         @wraps(f)
         def decorated_function(*args, **kwargs):
             _key = key or _build_key(f.__name__, *args, **kwargs)
@@ -67,14 +188,19 @@ def cached(*args, **kwargs):
                 _key = _key(*args, **kwargs)
 
             if not kwargs.pop('_skip_cache', False):
-                value = get(_key)
-                if value != None:
+                row = _get_row(_key)
+                if row and row[0] != None:
                     log('Cache Hit: {}'.format(_key))
-                    return value
+                    if stale_ttl and row[1] - stale_ttl < time():
+                        _refresh(_key, f, args, kwargs, expires + stale_ttl, stale_ttl)
+
+                    return row[0]
+
+                return _single_flight(_key, lambda: f(*args, **kwargs), expires + stale_ttl)
 
             value = f(*args, **kwargs)
             if value != None:
-                set(_key, value, expires)
+                set(_key, value, expires + stale_ttl)
 
             return value
 
@@ -83,18 +209,36 @@ def cached(*args, **kwargs):
 
     return lambda f: decorator(f, *args, **kwargs)
 
-def get(key, default=None):
+def _get_row(key):
     if not enabled():
-        return default
+        return None
 
     try:
-        return Cache.get(Cache.key == key, Cache.expires > time()).value
+        row = Cache.select(Cache.value, Cache.expires, Cache.accessed).where(Cache.key == key, Cache.expires > time()).get()
     except Cache.DoesNotExist:
-        return default
+        stats.misses += 1
+        return None
+
+    stats.hits += 1
+    # LRU order only needs coarse accuracy, so accessed is not rewritten on every hit
+    if row.accessed < time() - CACHE_CLEAN_INTERVAL:
+        stats.accessed.add(key)
+
+    value = row.value
+    if isinstance(value, peewee.buffer_type):
+        value = bytes(value)
+
+    return [cPickle.loads(value), row.expires]
+
+def get(key, default=None):
+    row = _get_row(key)
+    return default if row is None else row[0]
 
 def set(key, value, expires=CACHE_EXPIRY):
-    expires = int(time() + expires)
-    Cache.set(key=key, value=value, expires=expires)
+    _time = int(time())
+    value = cPickle.dumps(value)
+    Cache.set(key=key, value=value, expires=_time + expires, accessed=_time, size=len(value))
+    stats.changed = True
 
 def delete(key):
     return Cache.delete_where(Cache.key == key)
@@ -103,10 +247,75 @@ def empty():
     deleted = Cache.truncate()
     log('Cache: Deleted {} Rows'.format(deleted))
 
+def _keystore_get(key, default=None):
+    try:
+        return database.KeyStore.get(database.KeyStore.key == key).value
+    except database.KeyStore.DoesNotExist:
+        return default
+
+def evict():
+    count, size = Cache.select(peewee.fn.COUNT(Cache.id), peewee.fn.SUM(Cache.size)).scalar(as_tuple=True)
+    size = size or 0
+    if count <= CACHE_MAX_ROWS and size <= CACHE_MAX_SIZE:
+        return 0
+
+    ids = []
+    for row in Cache.select(Cache.id, Cache.size).order_by(Cache.accessed.asc()).tuples():
+        if count <= CACHE_MAX_ROWS and size <= CACHE_MAX_SIZE:
+            break
+
+        ids.append(row[0])
+        count -= 1
+        size -= row[1]
+
+    deleted = Cache.delete_where(Cache.id.in_(ids))
+    stats.evictions += deleted
+    log('Cache: Evicted {} Rows'.format(deleted))
+    return deleted
+
 @signals.on(signals.BEFORE_DISPATCH)
 def remove_expired():
-    deleted = Cache.delete_where(Cache.expires < int(time()))
+    _time = int(time())
+    if _time - int(_keystore_get(CACHE_CLEAN_KEY, 0)) < CACHE_CLEAN_INTERVAL:
+        return
+
+    deleted = Cache.delete_where(Cache.expires < _time)
     log('Cache: Deleted {} Expired Rows'.format(deleted))
+    evict()
+    database.KeyStore.set(key=CACHE_CLEAN_KEY, value=_time)
+
+@signals.on(signals.AFTER_DISPATCH)
+def flush():
+    if not stats.changed and not stats.accessed:
+        # hit / miss counters stay in memory until there is another write or CACHE_CLEAN_INTERVAL has passed
+        if not (stats.hits or stats.misses or stats.evictions) or time() - stats.saved < CACHE_CLEAN_INTERVAL:
+            return
+
+    was_closed = database.db.is_closed()
+
+    try:
+        with database.db.atomic():
+            if stats.accessed:
+                Cache.update(accessed=int(time())).where(Cache.key.in_(list(stats.accessed))).execute()
+
+            if stats.changed:
+                evict()
+
+            data = json.loads(_keystore_get(CACHE_STATS_KEY, '{}'))
+            for key in ('hits', 'misses', 'evictions'):
+                data[key] = data.get(key, 0) + getattr(stats, key)
+
+            database.KeyStore.set(key=CACHE_STATS_KEY, value=json.dumps(data))
+    except Exception as e:
+        log.debug('Cache: failed to flush stats ({})'.format(e))
+    finally:
+        if was_closed:
+            database.db.close()
+
+    stats.hits = stats.misses = stats.evictions = 0
+    stats.changed = False
+    stats.accessed.clear()
+    stats.saved = time()
 
 @router.route(ROUTE_CLEAR_CACHE)
 def clear_cache(key, **kwargs):
@@ -114,4 +323,14 @@ def clear_cache(key, **kwargs):
     msg = _(_.PLUGIN_CACHE_REMOVED, delete_count=delete_count)
     gui.notification(msg)
 
-database.tables.append(Cache)
\ No newline at end of file
+@router.route(ROUTE_CACHE_STATS)
+def cache_stats(**kwargs):
+    count, size = Cache.select(peewee.fn.COUNT(Cache.id), peewee.fn.SUM(Cache.size)).scalar(as_tuple=True)
+    data = json.loads(_keystore_get(CACHE_STATS_KEY, '{}'))
+    for key in ('hits', 'misses', 'evictions'):
+        data[key] = data.get(key, 0) + getattr(stats, key)
+
+    gui.text(_(_.CACHE_STATS_INFO, rows=count, size=int((size or 0)/1024), hits=data['hits'], misses=data['misses'], evictions=data['evictions']), heading=_.CACHE_STATS)
+
+database.tables.append(Cache)
+database.tables.append(CacheLock)
\ No newline at end of file
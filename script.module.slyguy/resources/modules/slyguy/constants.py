@@ -41,10 +41,19 @@ USERDATA_KEY = '_userdata'
 
 ##### CACHE #####
 CACHE_TABLENAME      = '_cache'
+CACHE_LOCK_TABLENAME = '_cache_lock'
 CACHE_CHECKSUM       = ADDON_VERSION # Recreates cache when new addon version
 CACHE_EXPIRY         = (60*60*24) # 24 Hours
 CACHE_CLEAN_INTERVAL = (60*60*4)  # 4 Hours
 CACHE_CLEAN_KEY      = '_cache_cleaned'
+CACHE_STATS_KEY      = '_cache_stats'
+CACHE_MAX_SIZE       = (1024*1024*50) # 50MB
+CACHE_MAX_ROWS       = 5000
+CACHE_LOCK_TIMEOUT   = 30 # Seconds
+CACHE_LOCK_POLL      = 0.1
+CACHE_REFRESH_WAIT   = 10 # Seconds
+MEM_CACHE_PATH       = os.path.join(ADDON_PROFILE, 'mem_cache.db')
+MEM_CACHE_MAX_SIZE   = (1024*1024*20) # 20MB
 #################
 
 IPTV_MERGE_ID        = 'plugin.program.iptv.merge'
@@ -57,6 +66,7 @@ ROUTE_IA_SETTINGS      = '_ia_settings'
 ROUTE_SETUP_MERGE      = '_setup_merge'
 ROUTE_IA_INSTALL       = '_ia_install'
 ROUTE_CLEAR_CACHE      = '_clear_cache'
+ROUTE_CACHE_STATS      = '_cache_stats'
 ROUTE_SERVICE          = '_service'
 ROUTE_SERVICE_INTERVAL = (60*5)
 ROUTE_LIVE_TAG         = '_l'
@@ -119,6 +129,13 @@ WIDEVINE_PSSH = bytearray([112, 115, 115, 104])
 DEFAULT_USERAGENT = 'okhttp/3.4.1'
 DEFAULT_WORKERS   = 5
 
+#### HTTP POOL #####
+POOL_MAXSIZE      = 20
+POOL_IDLE_TIMEOUT = 15 #seconds
+POOL_KEEPALIVE    = [('TCP_KEEPIDLE', 30), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3)]
+SERVER_WORKERS    = 8
+###################
+
 #### BOOKMARKS #####
 BOOKMARK_FILE = os.path.join(ADDON_PROFILE, 'bookmarks.json')
 
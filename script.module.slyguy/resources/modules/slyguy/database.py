@@ -132,6 +132,8 @@ class KeyStore(Model):
         table_name = DB_TABLENAME
 
 tables = [KeyStore]
+## Extra indexes (created with safe=True) so adding one doesn't change a table checksum and rebuild it
+indexes = []
 def check_tables():
     with db.atomic():
         for table in tables:
@@ -146,6 +148,9 @@ def check_tables():
 
             KeyStore.set(key=key, value=checksum)
 
+        for index in indexes:
+            db.execute(index)
+
 @signals.on(signals.AFTER_RESET)
 def delete():
     close()
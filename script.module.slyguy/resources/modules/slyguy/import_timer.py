@@ -0,0 +1,73 @@
+import sys
+import time
+
+from six.moves import builtins
+
+REPORT_SIZE = 30
+
+_start   = None
+_import  = None
+_stack   = []
+_timings = {}
+
+def install():
+    # Times first imports of every module, similar to python -X importtime
+    global _start, _import
+    if _import:
+        return
+
+    _start  = time.time()
+    _import = builtins.__import__
+    builtins.__import__ = _timed_import
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    key = name
+    if level and globals:
+        key = '{}.{}'.format(globals.get('__package__') or '', name).strip('.')
+
+    if key in sys.modules or key in _timings:
+        ## from package import submodule
+        if fromlist and hasattr(sys.modules.get(key), '__path__'):
+            for item in fromlist:
+                sub_key = '{}.{}'.format(key, item)
+                if item != '*' and sub_key not in sys.modules and sub_key not in _timings:
+                    try: _timed_import(sub_key)
+                    except ImportError: pass
+
+        return _import(name, globals, locals, fromlist, level)
+
+    _timings[key] = None
+    _stack.append(0)
+    start = time.time()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - start
+        children = _stack.pop()
+        if _stack:
+            _stack[-1] += elapsed
+        _timings[key] = (elapsed - children, elapsed)
+
+def mark():
+    # reuselanguageinvoker keeps the interpreter between dispatches, so later dispatches are timed from their own start
+    global _start
+    if _import and _start is None:
+        _start = time.time()
+
+def report():
+    global _start
+    if not _import or _start is None:
+        return
+
+    from .log import log
+
+    rows = sorted([(key, value) for key, value in _timings.items() if value], key=lambda x: x[1][1], reverse=True)
+    lines = ['Startup: {:.1f}ms / {} modules imported'.format((time.time() - _start) * 1000, len(rows))]
+    lines.append('{:>10} | {:>10} | {}'.format('self (ms)', 'total (ms)', 'module'))
+    for key, value in rows[:REPORT_SIZE]:
+        lines.append('{:>10.1f} | {:>10.1f} | {}'.format(value[0] * 1000, value[1] * 1000, key))
+
+    log.debug('\n'.join(lines))
+
+    _start = None
+    _timings.clear()
@@ -5,7 +5,6 @@ import shutil
 import time
 import struct
 import subprocess
-from distutils.version import LooseVersion
 
 from kodi_six import xbmc, xbmcaddon
 
@@ -210,6 +209,8 @@ def open_settings():
         ia_addon.openSettings()
 
 def require_version(required_version, required=False):
+    from distutils.version import LooseVersion
+
     ia_addon = get_ia_addon(required=required)
     if not ia_addon:
         return False
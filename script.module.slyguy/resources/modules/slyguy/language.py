@@ -163,6 +163,12 @@ class BaseLanguage(object):
     WV_REVOKED_CONFIRM          = 32123
     WV_FAILED                   = 32124
     IA_TVOS_ERROR               = 32125
+    PROXY_PREFETCH              = 32126
+    PROXY_PREFETCH_SEGMENTS     = 32127
+    PROXY_PREFETCH_SIZE         = 32128
+    POOLED_SERVER               = 32129
+    CACHE_STATS                 = 32130
+    CACHE_STATS_INFO            = 32131
 
     def __getattribute__(self, name):
         attr = object.__getattribute__(self, name)
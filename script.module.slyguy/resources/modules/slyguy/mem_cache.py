@@ -1,37 +1,63 @@
+import os
 import sys
-from time import time
+import sqlite3
+import threading
+from time import time, sleep
 from functools import wraps
 from copy import deepcopy
 
 from six.moves import cPickle
 
 from .log import log
-from .util import hash_6, set_kodi_string, get_kodi_string
-from .constants import ADDON_ID, CACHE_EXPIRY, ROUTE_CLEAR_CACHE, ADDON_VERSION
+from .util import hash_6
+from .language import _
+from .constants import ADDON_ID, CACHE_EXPIRY, CACHE_CLEAN_INTERVAL, ROUTE_CLEAR_CACHE, ADDON_VERSION, MEM_CACHE_PATH, MEM_CACHE_MAX_SIZE, CACHE_LOCK_TIMEOUT, CACHE_LOCK_POLL, CACHE_REFRESH_WAIT
 from . import signals, gui, router
 from .settings import common_settings as settings
 
-cache_key = 'cache.'+ADDON_ID+ADDON_VERSION
-
 class Cache(object):
     data = {}
+    accessed = set()
+    written = False
+    local = threading.local()
+    refreshing = set()
+    pending = []
+    lock = threading.Lock()
+    key_locks = {}
 
 cache = Cache()
 
-@signals.on(signals.BEFORE_DISPATCH)
-def load():
-    if not cache.data and settings.getBool('persist_cache', True):
-        cache.data = {}
+def _persist():
+    return settings.getBool('persist_cache', True)
 
-        try:
-            data = get_kodi_string(cache_key)
-            cache.data = cPickle.loads(data.encode('latin1'))
-        except Exception as e:
-            log.debug('load cache failed')
-        else:
-            log.debug('Cache data loaded')
+def _connect():
+    conn = getattr(cache.local, 'conn', None)
+    if conn:
+        return conn
+
+    path = os.path.dirname(MEM_CACHE_PATH)
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    conn = sqlite3.connect(MEM_CACHE_PATH, timeout=10, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=0')
+    conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires INTEGER, accessed INTEGER, size INTEGER)')
+    conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS locks (key TEXT PRIMARY KEY, expires INTEGER)')
+
+    row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    if not row or row[0] != ADDON_ID+ADDON_VERSION:
+        conn.execute('DELETE FROM cache')
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (ADDON_ID+ADDON_VERSION,))
 
-        set_kodi_string(cache_key, "{}")
+    cache.local.conn = conn
+    return conn
+
+@signals.on(signals.BEFORE_DISPATCH)
+def load():
+    # rows are loaded per key on first get
+    cache.accessed.clear()
 
 def set(key, value, expires=CACHE_EXPIRY):
     if expires == 0:
@@ -43,25 +69,76 @@ def set(key, value, expires=CACHE_EXPIRY):
     log('Cache Set: {}'.format(key))
     cache.data[key] = [deepcopy(value), expires]
 
-def get(key, default=None):
+    if not _persist():
+        return
+
+    try:
+        data = cPickle.dumps(value, protocol=2)
+        _connect().execute('INSERT OR REPLACE INTO cache (key, value, expires, accessed, size) VALUES (?, ?, ?, ?, ?)',
+            (key, sqlite3.Binary(data), expires, int(time()), len(data)))
+        cache.written = True
+    except Exception as e:
+        log.debug('Mem Cache: set failed ({})'.format(e))
+
+def _load(key):
     try:
-        row = cache.data[key]
-    except KeyError:
-        return default
+        row = _connect().execute('SELECT value, expires, accessed FROM cache WHERE key = ?', (key,)).fetchone()
+        if not row:
+            return None
+
+        accessed = row[2]
+        row = [cPickle.loads(bytes(row[0])), row[1]]
+    except Exception as e:
+        log.debug('Mem Cache: load failed ({})'.format(e))
+        return None
+
+    cache.data[key] = row
+    # LRU order only needs to be roughly right, so access times are written at most once per clean interval
+    if (accessed or 0) < time() - CACHE_CLEAN_INTERVAL:
+        cache.accessed.add(key)
+
+    return row
+
+def _get_row(key):
+    row = cache.data.get(key)
+    if row is None and _persist():
+        row = _load(key)
+
+    if row is None:
+        return None
 
     if row[1] != None and row[1] < time():
-        cache.data.pop(key, None)
-        return default
+        delete(key)
+        return None
     else:
         log('Cache Hit: {}'.format(key))
-        return row[0]
+        return row
+
+def get(key, default=None):
+    row = _get_row(key)
+    return default if row is None else row[0]
 
 def delete(key):
-    return int(cache.data.pop(key, None) != None)
+    deleted = cache.data.pop(key, None) != None
+
+    if _persist():
+        try:
+            deleted = _connect().execute('DELETE FROM cache WHERE key = ?', (key,)).rowcount > 0 or deleted
+        except Exception as e:
+            log.debug('Mem Cache: delete failed ({})'.format(e))
+
+    return int(deleted)
 
 def empty():
     deleted = len(cache.data)
     cache.data.clear()
+
+    if _persist():
+        try:
+            deleted = _connect().execute('DELETE FROM cache').rowcount
+        except Exception as e:
+            log.debug('Mem Cache: empty failed ({})'.format(e))
+
     log('Mem Cache: Deleted {} Rows'.format(deleted))
 
 def key_for(f, *args, **kwargs):
@@ -95,8 +172,107 @@ def _build_key(func_name, *args, **kwargs):
 
     return hash_6(key)
 
+def _key_lock(key):
+    with cache.lock:
+        if key not in cache.key_locks:
+            cache.key_locks[key] = threading.Lock()
+
+        return cache.key_locks[key]
+
+def _acquire(key, min_expires):
+    # row lock shared by every process using this add-on's cache. returns False once another process has filled the key
+    conn = _connect()
+    deadline = time() + CACHE_LOCK_TIMEOUT
+
+    while time() < deadline:
+        try:
+            conn.execute('INSERT INTO locks (key, expires) VALUES (?, ?)', (key, int(time() + CACHE_LOCK_TIMEOUT)))
+            return True
+        except sqlite3.IntegrityError:
+            pass
+
+        if _is_fresh(_load(key), min_expires):
+            return False
+
+        conn.execute('DELETE FROM locks WHERE key = ? AND expires < ?', (key, int(time())))
+        sleep(CACHE_LOCK_POLL)
+
+    log.debug('Cache: lock wait timed out for {}'.format(key))
+    return False
+
+def _is_fresh(row, min_expires):
+    return row and row[0] != None and (row[1] == None or row[1] >= max(min_expires, time()))
+
+def _single_flight(key, func, expires, min_expires=0):
+    with _key_lock(key):
+        row = _get_row(key)
+        if _is_fresh(row, min_expires):
+            return row[0]
+
+        locked = False
+        try:
+            if _persist():
+                try:
+                    locked = _acquire(key, min_expires)
+                    # may have been filled by another process just before we got the lock
+                    row = _load(key)
+                except Exception as e:
+                    log.debug('Cache: lock failed ({})'.format(e))
+                else:
+                    if _is_fresh(row, min_expires):
+                        return row[0]
+
+            value = func()
+            if value != None:
+                set(key, value, expires)
+
+            return value
+        finally:
+            if locked:
+                _connect().execute('DELETE FROM locks WHERE key = ?', (key,))
+
+def _refresh(key, f, args, kwargs, expires, stale_ttl):
+    with cache.lock:
+        if key in cache.refreshing:
+            return
+
+        cache.refreshing.add(key)
+
+    log('Cache Stale: {}'.format(key))
+    cache.pending.append((key, f, args, kwargs, expires, stale_ttl))
+
+@signals.on(signals.ON_CLOSE, first=True)
+def run_refreshes():
+    # Stale rows are refreshed once the route has finished (provider API objects are not thread safe)
+    if not cache.pending:
+        return
+
+    jobs = cache.pending[:]
+    del cache.pending[:]
+
+    def worker():
+        for key, f, args, kwargs, expires, stale_ttl in jobs:
+            try:
+                _single_flight(key, lambda: f(*args, **kwargs), expires, min_expires=time() + stale_ttl)
+            except Exception as e:
+                log.debug('Cache: background refresh of {} failed ({})'.format(key, e))
+            finally:
+                with cache.lock:
+                    cache.refreshing.discard(key)
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    thread.join(CACHE_REFRESH_WAIT)
+    if thread.is_alive():
+        log.debug('Cache: background refresh still running after {}s'.format(CACHE_REFRESH_WAIT))
+
 def cached(*args, **kwargs):
-    def decorator(f, expires=CACHE_EXPIRY, key=None):
+    def decorator(f, expires=CACHE_EXPIRY, key=None, stale_ttl=None):
+        # with stale_ttl, rows are kept for expires + stale_ttl and a stale row is returned while it refreshes in the background
+        if not stale_ttl or not expires:
+            stale_ttl = 0
+
         @wraps(f)
         def decorated_function(*args, **kwargs):
             _key = key or _build_key(f.__name__, *args, **kwargs)
@@ -104,13 +280,19 @@ def cached(*args, **kwargs):
                 _key = _key(*args, **kwargs)
 
             if not kwargs.pop('_skip_cache', False):
-                value = get(_key)
-                if value != None:
-                    return value
+                row = _get_row(_key)
+                if row and row[0] != None:
+                    if stale_ttl and row[1] - stale_ttl < time():
+                        _refresh(_key, f, args, kwargs, expires + stale_ttl, stale_ttl)
+
+                    return row[0]
+
+                if expires != 0:
+                    return _single_flight(_key, lambda: f(*args, **kwargs), expires + stale_ttl if stale_ttl else expires)
 
             value = f(*args, **kwargs)
             if value != None:
-                set(_key, value, expires)
+                set(_key, value, expires + stale_ttl if stale_ttl else expires)
 
             return value
 
@@ -120,22 +302,54 @@ def cached(*args, **kwargs):
 
 @signals.on(signals.AFTER_DISPATCH)
 def remove_expired():
-    _time = time()
-    delete  = []
+    _time = int(time())
 
-    for key in cache.data.keys():
-        if cache.data[key][1] < _time:
-            delete.append(key)
+    if not _persist():
+        delete = [key for key in cache.data if cache.data[key][1] != None and cache.data[key][1] < _time]
+        for key in delete:
+            cache.data.pop(key, None)
 
-    for key in delete:
-        cache.data.pop(key, None)
+        if delete:
+            log('Mem Cache: Deleted {} Expired Rows'.format(len(delete)))
 
-    if delete:
-        log('Mem Cache: Deleted {} Expired Rows'.format(len(delete)))
+        return
 
-    if settings.getBool('persist_cache', True):
-        set_kodi_string(cache_key, cPickle.dumps(cache.data, protocol=0).decode('latin1'))
-        cache.data.clear()
+    cache.data.clear()
+    written = cache.written
+    cache.written = False
+
+    try:
+        conn = _connect()
+        if cache.accessed:
+            conn.executemany('UPDATE cache SET accessed = ? WHERE key = ?', [(_time, key) for key in cache.accessed])
+            cache.accessed.clear()
+
+        ## The size bound can only be passed by a write. Expired rows are skipped on read, so they are only cleaned every CACHE_CLEAN_INTERVAL
+        if not written:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'cleaned'").fetchone()
+            if row and _time - int(row[0]) < CACHE_CLEAN_INTERVAL:
+                return
+
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('cleaned', ?)", (str(_time),))
+
+        deleted = conn.execute('DELETE FROM cache WHERE expires < ?', (_time,)).rowcount
+        if deleted:
+            log('Mem Cache: Deleted {} Expired Rows'.format(deleted))
+
+        total = conn.execute('SELECT SUM(size) FROM cache').fetchone()[0] or 0
+        if total > MEM_CACHE_MAX_SIZE:
+            evict = []
+            for key, size in conn.execute('SELECT key, size FROM cache ORDER BY accessed ASC').fetchall():
+                if total <= MEM_CACHE_MAX_SIZE:
+                    break
+
+                evict.append((key,))
+                total -= size
+
+            conn.executemany('DELETE FROM cache WHERE key = ?', evict)
+            log('Mem Cache: Evicted {} Rows'.format(len(evict)))
+    except Exception as e:
+        log.debug('Mem Cache: cleanup failed ({})'.format(e))
 
 @router.route(ROUTE_CLEAR_CACHE)
 def clear_cache(key, **kwargs):
@@ -7,7 +7,6 @@ import json
 from functools import wraps
 from six.moves.urllib_parse import quote_plus
 
-from pycaption import detect_format, WebVTTWriter
 from kodi_six import xbmc, xbmcplugin
 from six.moves.urllib.parse import quote
 
@@ -266,6 +265,8 @@ def _settings(**kwargs):
 @route(ROUTE_WEBVTT)
 @plugin_callback()
 def _webvtt(url, _data_path, _headers, **kwargs):
+    from pycaption import detect_format, WebVTTWriter
+
     r = Session().get(url, headers=_headers)
 
     data = r.content.decode('utf8')
@@ -1,7 +1,7 @@
 import sys
 from six.moves.urllib_parse import parse_qsl, urlparse, urlencode
 
-from . import signals
+from . import signals, import_timer
 from .constants import *
 from .log import log
 from .language import _
@@ -105,6 +105,8 @@ def redirect(url):
 
 # router.dispatch('?_=_settings')
 def dispatch(url):
+    import_timer.mark()
+
     with signals.throwable():
         signals.emit(signals.BEFORE_DISPATCH)
         function, params = parse_url(url)
@@ -120,4 +122,5 @@ def dispatch(url):
             else:
                 raise
 
-    signals.emit(signals.AFTER_DISPATCH)
\ No newline at end of file
+    signals.emit(signals.AFTER_DISPATCH)
+    import_timer.report()
\ No newline at end of file
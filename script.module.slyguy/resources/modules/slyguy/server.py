@@ -0,0 +1,80 @@
+import threading
+
+from six.moves import queue
+from six.moves.BaseHTTPServer import HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+
+from . import settings
+from .log import log
+from .constants import SERVER_WORKERS
+
+BUSY_RESPONSE = b'HTTP/1.0 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class PooledHTTPServer(HTTPServer):
+    # Accepted connections are queued to a fixed set of worker threads instead of a new thread per request.
+    # When the queue is full new connections get a 503 so the accept loop never blocks
+    def __init__(self, server_address, RequestHandlerClass, workers=SERVER_WORKERS):
+        HTTPServer.__init__(self, server_address, RequestHandlerClass)
+        self._requests = queue.Queue(workers*4)
+        self._workers = []
+
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._workers.append(thread)
+
+    def process_request(self, request, client_address):
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            log.debug('HTTP server busy. Rejecting {}'.format(client_address))
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except Exception:
+                pass
+            finally:
+                self.shutdown_request(request)
+
+    def _worker(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+
+        ## Drop queued connections so the stop sentinels always fit
+        while True:
+            try:
+                item = self._requests.get_nowait()
+            except queue.Empty:
+                break
+
+            if item is not None:
+                self.shutdown_request(item[0])
+
+        for thread in self._workers:
+            try:
+                self._requests.put_nowait(None)
+            except queue.Full:
+                break
+
+def create_server(server_address, RequestHandlerClass, workers=SERVER_WORKERS):
+    if settings.common_settings.getBool('pooled_server', False):
+        log.debug('Using pooled HTTP server ({} workers)'.format(workers))
+        return PooledHTTPServer(server_address, RequestHandlerClass, workers=workers)
+    else:
+        return ThreadedHTTPServer(server_address, RequestHandlerClass)
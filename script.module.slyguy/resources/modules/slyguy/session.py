@@ -1,9 +1,13 @@
 import json
 import socket
 import re
+import time
+import threading
 from gzip import GzipFile
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
 from six import BytesIO
 
 from . import userdata, settings
@@ -11,7 +15,7 @@ from .util import get_dns_rewrites
 from .log import log
 from .language import _
 from .exceptions import SessionError
-from .constants import DEFAULT_USERAGENT, CHUNK_SIZE
+from .constants import DEFAULT_USERAGENT, CHUNK_SIZE, POOL_MAXSIZE, POOL_IDLE_TIMEOUT, POOL_KEEPALIVE
 
 DEFAULT_HEADERS = {
     'User-Agent': DEFAULT_USERAGENT,
@@ -25,13 +29,132 @@ def json_override(func, error_msg):
 
 orig_getaddrinfo = socket.getaddrinfo
 
+KEEPALIVE_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+for name, value in POOL_KEEPALIVE:
+    if hasattr(socket, name):
+        KEEPALIVE_OPTIONS.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+
+class PoolStats(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.requests = 0
+        self.connects = 0
+        self.connect_time = 0.0
+        self.idle_closed = 0
+        self.last_used = time.time()
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'connects': self.connects,
+            'idle_closed': self.idle_closed,
+            'reuse_rate': round(1 - (float(self.connects) / self.requests), 2) if self.requests else 0,
+            'avg_connect_ms': int(self.connect_time * 1000 / self.connects) if self.connects else 0,
+        }
+
+class _StatsConnection(object):
+    def __init__(self, *args, **kwargs):
+        self._pool_stats = kwargs.pop('pool_stats', None)
+        super(_StatsConnection, self).__init__(*args, **kwargs)
+
+    def connect(self):
+        start = time.time()
+        super(_StatsConnection, self).connect()
+
+        if self._pool_stats:
+            self._pool_stats.connects += 1
+            self._pool_stats.connect_time += time.time() - start
+
+class StatsHTTPConnection(_StatsConnection, HTTPConnection):
+    pass
+
+class StatsHTTPSConnection(_StatsConnection, HTTPSConnection):
+    pass
+
+class PoolAdapter(HTTPAdapter):
+    def __init__(self, pool_maxsize=POOL_MAXSIZE, idle_timeout=POOL_IDLE_TIMEOUT, **kwargs):
+        self._idle_timeout = idle_timeout
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+        super(PoolAdapter, self).__init__(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = KEEPALIVE_OPTIONS
+        super(PoolAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def get_connection(self, url, proxies=None):
+        pool = super(PoolAdapter, self).get_connection(url, proxies)
+        now = time.time()
+
+        with self._lock:
+            key = u'{}:{}'.format(pool.host, pool.port)
+            stats = self._stats.get(key)
+            if not stats or stats.pool is not pool:
+                stats = self._stats[key] = self._track_pool(pool, stats)
+
+            if now - self._last_sweep >= self._idle_timeout:
+                self._last_sweep = now
+                for _stats in self._stats.values():
+                    if now - _stats.last_used >= self._idle_timeout:
+                        self._close_idle(_stats)
+
+            stats.requests += 1
+            stats.last_used = now
+
+        return pool
+
+    def _track_pool(self, pool, old_stats=None):
+        stats = PoolStats(pool)
+        if old_stats:
+            stats.requests, stats.connects, stats.connect_time, stats.idle_closed = old_stats.requests, old_stats.connects, old_stats.connect_time, old_stats.idle_closed
+
+        if pool.ConnectionCls is HTTPConnection:
+            pool.ConnectionCls = StatsHTTPConnection
+        elif pool.ConnectionCls is HTTPSConnection:
+            pool.ConnectionCls = StatsHTTPSConnection
+        else:
+            return stats
+
+        pool.conn_kw['pool_stats'] = stats
+        return stats
+
+    def _close_idle(self, stats):
+        # Servers drop idle keep-alive sockets. Close them first so the next request doesn't hit 'Connection aborted'
+        queue = stats.pool.pool
+        if queue is None:
+            return
+
+        with queue.mutex:
+            for conn in queue.queue:
+                if conn and conn.sock:
+                    conn.close()
+                    stats.idle_closed += 1
+
+    def stats(self):
+        with self._lock:
+            return dict((key, self._stats[key].to_dict()) for key in self._stats)
+
 class RawSession(requests.Session):
-    def __init__(self):
+    def __init__(self, pool_size=None):
         super(RawSession, self).__init__()
         self._dns_rewrites = []
         self._rewrite_cache = {}
         socket.getaddrinfo = lambda *args, **kwargs: self._getaddrinfoPreferIPv4(*args, **kwargs)
 
+        if pool_size:
+            adapter = PoolAdapter(pool_maxsize=pool_size)
+            self.mount('https://', adapter)
+            self.mount('http://', adapter)
+
+    def pool_stats(self):
+        stats = {}
+        for adapter in set(self.adapters.values()):
+            if isinstance(adapter, PoolAdapter):
+                stats.update(adapter.stats())
+
+        return stats
+
     def set_dns_rewrites(self, rewrites):
         self._dns_rewrites = rewrites
         self._rewrite_cache = {}
@@ -137,6 +260,12 @@ class Session(RawSession):
         resp = self.request(method, url, **kwargs)
         resp.raise_for_status()
 
+        if resp.status_code == 304:
+            resp.close()
+            return resp
+
         with open(dst_path, 'wb') as f:
             for chunk in resp.iter_content(CHUNK_SIZE):
-                f.write(chunk)
\ No newline at end of file
+                f.write(chunk)
+
+        return resp
\ No newline at end of file
@@ -8,16 +8,46 @@ from . import signals
 from .log import log
 from .util import remove_file
 
+# (addon_id, key) -> value snapshot. Only used between BEFORE_DISPATCH and AFTER_DISPATCH so long running services always read live values
+_snapshot = None
+
 @signals.on(signals.BEFORE_DISPATCH)
 def before_dispatch():
     #refresh settings
-    global ADDON
+    global ADDON, _snapshot
     ADDON = xbmcaddon.Addon(ADDON.getAddonInfo('id'))
     check_corrupt(ADDON)
     common_settings.reset()
+    _snapshot = {}
+
+@signals.on(signals.AFTER_DISPATCH)
+def after_dispatch():
+    global _snapshot
+    _snapshot = None
+
+def _get(addon, addon_id, key):
+    if _snapshot is None:
+        return addon.getSetting(key)
+
+    try:
+        return _snapshot[(addon_id, key)]
+    except KeyError:
+        value = _snapshot[(addon_id, key)] = addon.getSetting(key)
+        return value
+
+def _set(addon, addon_id, key, value):
+    value = str(value)
+    addon.setSetting(key, value)
+    if _snapshot is not None:
+        _snapshot[(addon_id, key)] = value
+
+def _clear_snapshot():
+    if _snapshot is not None:
+        _snapshot.clear()
 
 def open():
     ADDON.openSettings()
+    _clear_snapshot()
 
 def getDict(key, default=None):
     try:
@@ -67,18 +97,20 @@ def setBool(key, value=True):
     set(key, 'true' if value else 'false')
 
 def get(key, default=''):
-    return ADDON.getSetting(key) or default
+    return _get(ADDON, ADDON_ID, key) or default
 
 def set(key, value=''):
-    ADDON.setSetting(key, str(value))
+    _set(ADDON, ADDON_ID, key, value)
 
 class Settings(object):
     def __init__(self, _addon=None):
         self._addon = _addon or ADDON
+        self._id = self._addon.getAddonInfo('id')
         check_corrupt(self._addon)
 
     def open(self):
         self._addon.openSettings()
+        _clear_snapshot()
 
     def getDict(self, key, default=None):
         try:
@@ -87,7 +119,7 @@ class Settings(object):
             return default
 
     def reset(self):
-        self._addon = xbmcaddon.Addon(self._addon.getAddonInfo('id'))
+        self._addon = xbmcaddon.Addon(self._id)
 
     def setDict(self, key, value):
         self.set(key, json.dumps(value, separators=(',', ':')))
@@ -131,10 +163,10 @@ class Settings(object):
         self.set(key, 'true' if value else 'false')
 
     def get(self, key, default=''):
-        return self._addon.getSetting(key) or default
+        return _get(self._addon, self._id, key) or default
 
     def set(self, key, value=''):
-        self._addon.setSetting(key, str(value))
+        _set(self._addon, self._id, key, value)
 
 def check_corrupt(addon):
     if addon.getAddonInfo('id') != ADDON_ID:
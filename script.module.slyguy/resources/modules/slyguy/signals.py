@@ -14,9 +14,12 @@ ON_ERROR        = 'on_error'
 ON_EXCEPTION    = 'on_exception'
 ON_CLOSE        = 'on_close'
 
-def on(signal):
+def on(signal, first=False):
     def decorator(f):
-        _signals[signal].append(f)
+        if first:
+            _signals[signal].insert(0, f)
+        else:
+            _signals[signal].append(f)
         return f
     return decorator
 
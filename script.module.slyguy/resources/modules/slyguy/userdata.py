@@ -1,11 +1,40 @@
+import json
+from copy import deepcopy
+
 from . import settings
 from .constants import ADDON, USERDATA_KEY
 
+# [raw json, parsed dict] so the blob is only parsed again when the setting changes
+_cache = [None, None]
+
+def _load(raw, cache):
+    if raw != cache[0]:
+        try:
+            data = json.loads(raw)
+        except:
+            data = {}
+
+        cache[:] = [raw, data]
+
+    return cache[1]
+
+def _dump(data, cache):
+    raw = json.dumps(data, separators=(',', ':'))
+    cache[:] = [raw, data]
+    return raw
+
+def _value(data, key, default):
+    value = data.get(key, default)
+    # callers may modify returned lists / dicts without saving them
+    if isinstance(value, (list, dict)):
+        value = deepcopy(value)
+    return value
+
 def _get_data():
-    return settings.getDict(USERDATA_KEY, {})
+    return _load(settings.get(USERDATA_KEY), _cache)
 
 def get(key, default=None):
-    return _get_data().get(key, default)
+    return _value(_get_data(), key, default)
 
 def set(key, value):
     data = _get_data()
@@ -13,7 +42,7 @@ def set(key, value):
     _set_data(data)
 
 def _set_data(data):
-    settings.setDict(USERDATA_KEY, data)
+    settings.set(USERDATA_KEY, _dump(data, _cache))
 
 def pop(key, default=None):
     data = _get_data()
@@ -33,12 +62,13 @@ def clear():
 class Userdata(object):
     def __init__(self, _addon=None):
         self._settings = settings.Settings(_addon or ADDON)
+        self._cache = [None, None]
 
     def _get_data(self):
-        return self._settings.getDict(USERDATA_KEY, {})
+        return _load(self._settings.get(USERDATA_KEY), self._cache)
 
     def get(self, key, default=None):
-        return self._get_data().get(key, default)
+        return _value(self._get_data(), key, default)
 
     def set(self, key, value):
         data = self._get_data()
@@ -46,7 +76,7 @@ class Userdata(object):
         self._set_data(data)
 
     def _set_data(self, data):
-        self._settings.setDict(USERDATA_KEY, data)
+        self._settings.set(USERDATA_KEY, _dump(data, self._cache))
 
     def pop(self, key, default=None):
         data = self._get_data()
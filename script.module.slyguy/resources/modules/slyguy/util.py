@@ -411,7 +411,12 @@ def md5sum(filepath):
     if not os.path.exists(filepath):
         return None
 
-    return hashlib.md5(open(filepath,'rb').read()).hexdigest()
+    h = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
 
 ## to find BCOV-POLICY. Open below url
 ## account_id / player_id / videoid can be found by right clicking player and selecting Player Information
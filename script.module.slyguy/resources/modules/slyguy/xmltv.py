@@ -0,0 +1,148 @@
+import re
+import time
+import codecs
+import datetime
+from contextlib import contextmanager
+
+from six import string_types, integer_types
+
+ISO_RE     = re.compile(r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d)(?::(\d\d)(?:\.\d+)?)?\s*(Z|[+-]\d\d:?\d\d)?$')
+ESCAPE_RE  = re.compile(u'[&<>"]')
+ESCAPES    = {u'&': u'&amp;', u'<': u'&lt;', u'>': u'&gt;', u'"': u'&quot;'}
+FLUSH_SIZE = 1000
+
+_offsets = {}
+
+def _offset(value):
+    # value is either a +HH:MM / Z string or a utcoffset timedelta
+    try:
+        return _offsets[value]
+    except KeyError:
+        pass
+
+    if isinstance(value, datetime.timedelta):
+        seconds = value.days * 86400 + value.seconds
+        sign = '-' if seconds < 0 else '+'
+        hours, minutes = divmod(abs(seconds) // 60, 60)
+        offset = u'{}{:02d}{:02d}'.format(sign, hours, minutes)
+    elif not value or value == 'Z':
+        offset = u'+0000'
+    else:
+        offset = value.replace(':', '')
+
+    _offsets[value] = offset
+    return offset
+
+def xmltv_time(value):
+    # Same output as arrow.get(value).format('YYYYMMDDHHmmss Z') without building arrow objects
+    if isinstance(value, string_types):
+        match = ISO_RE.match(value)
+        if match:
+            year, month, day, hour, minute, second, offset = match.groups()
+            return u'{}{}{}{}{}{} {}'.format(year, month, day, hour, minute, second or '00', _offset(offset))
+
+    elif isinstance(value, integer_types + (float,)) and not isinstance(value, bool):
+        return time.strftime('%Y%m%d%H%M%S +0000', time.gmtime(int(value)))
+
+    elif isinstance(value, datetime.datetime):
+        return u'{} {}'.format(value.strftime('%Y%m%d%H%M%S'), _offset(value.utcoffset() or datetime.timedelta(0)))
+
+    elif hasattr(value, 'datetime'):
+        return xmltv_time(value.datetime)
+
+    import arrow
+    return arrow.get(value).format('YYYYMMDDHHmmss Z')
+
+def escape(value):
+    if value is None:
+        return u''
+
+    if not isinstance(value, string_types):
+        value = u'{}'.format(value)
+
+    if ESCAPE_RE.search(value) is None:
+        return value
+
+    return ESCAPE_RE.sub(lambda match: ESCAPES[match.group(0)], value)
+
+class XMLTVWriter(object):
+    def __init__(self, f):
+        self._f = f
+        self._parts = []
+
+    def _add(self, *parts):
+        self._parts.extend(parts)
+        if len(self._parts) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self._f.write(u''.join(self._parts))
+            self._parts = []
+
+    def start(self):
+        self._f.write(u'<?xml version="1.0" encoding="utf-8" ?><tv>')
+
+    def end(self):
+        self.flush()
+        self._f.write(u'</tv>')
+
+    def channel(self, id, name=None, icon=None):
+        self._add(u'<channel id="', escape(id), u'">')
+        if name:
+            self._add(u'<display-name>', escape(name), u'</display-name>')
+        if icon:
+            self._add(u'<icon src="', escape(icon), u'"/>')
+        self._add(u'</channel>')
+
+    def programme(self, channel, start, stop, title, subtitle=None, desc=None, icon=None, date=None, episode=None, genre=None, genre_lang=None, credits=None, catchup_id=None):
+        self._add(u'<programme start="', xmltv_time(start), u'" stop="', xmltv_time(stop), u'" channel="', escape(channel), u'"')
+        if catchup_id:
+            self._add(u' catchup-id="', escape(catchup_id), u'"')
+        self._add(u'><title>', escape(title), u'</title>')
+
+        if subtitle:
+            self._add(u'<sub-title>', escape(subtitle), u'</sub-title>')
+        if desc:
+            self._add(u'<desc>', escape(desc), u'</desc>')
+        if date:
+            self._add(u'<date>', escape(date), u'</date>')
+        if icon:
+            self._add(u'<icon src="', escape(icon), u'"/>')
+        if episode:
+            self._add(u'<episode-num system="onscreen">', escape(episode), u'</episode-num>')
+
+        if genre:
+            if not isinstance(genre, (list, tuple)):
+                genre = [genre]
+
+            category = u'<category lang="{}">'.format(escape(genre_lang)) if genre_lang else u'<category>'
+            for row in genre:
+                self._add(category, escape(row), u'</category>')
+
+        if credits:
+            self._add(u'<credits>')
+            for credit in credits:
+                if not credit.get('type') or not credit.get('name'):
+                    continue
+
+                if credit['type'] in ('actor', 'presenter', 'commentator', 'guest'):
+                    if credit.get('role'):
+                        self._add(u'<actor role="', escape(credit['role']), u'">', escape(credit['name']), u'</actor>')
+                    else:
+                        self._add(u'<actor>', escape(credit['name']), u'</actor>')
+                elif credit['type'] in ('director', 'producer'):
+                    self._add(u'<director>', escape(credit['name']), u'</director>')
+                elif credit['type'] in ('writer', 'adapter', 'composer', 'editor'):
+                    self._add(u'<writer>', escape(credit['name']), u'</writer>')
+            self._add(u'</credits>')
+
+        self._add(u'</programme>')
+
+@contextmanager
+def open_xmltv(file_path):
+    with codecs.open(file_path, 'w', encoding='utf8') as f:
+        writer = XMLTVWriter(f)
+        writer.start()
+        yield writer
+        writer.end()
@@ -1,6 +1,5 @@
 import codecs
 import re
-from xml.sax.saxutils import escape
 
 import arrow
 from kodi_six import xbmcplugin
@@ -9,6 +8,7 @@ from six.moves.urllib_parse import urlparse, parse_qsl
 from slyguy import plugin, gui, settings, userdata, signals, inputstream
 from slyguy.exceptions import PluginError
 from slyguy.constants import ROUTE_LIVE_TAG
+from slyguy.xmltv import open_xmltv
 
 from .api import API
 from .language import _
@@ -363,35 +363,20 @@ def playlist(output, **kwargs):
 def epg(output, **kwargs):
     data = api.content(LIVE_TV_SLUG)
 
-    with codecs.open(output, 'w', encoding='utf8') as f:
-        f.write(u'<?xml version="1.0" encoding="utf-8" ?><tv>')
-
+    with open_xmltv(output) as writer:
         for section in data['items']:
             if section['type'] != 'channelShelf':
                 continue
 
             for channel in section['mediaItems']:
-                f.write(u'<channel id="{id}"></channel>'.format(id=channel['channelId']))
+                writer.channel(channel['channelId'])
 
             for channel in section['mediaItems']:
                 for epg in channel['schedules']['items']:
-                    start = arrow.get(epg['startTime'])
-                    stop  = arrow.get(epg['endTime'])
-
-                    icon = u'<icon src="{}"/>'.format(escape(IMAGE_URL.format(url=epg['mediaImage']['url'], width=IMAGE_WIDTH))) if epg['mediaImage'].get('url') else ''
-                    desc = u'<desc>{}</desc>'.format(escape(epg['synopsis'])) if epg['synopsis'] else ''
-                    genre = u'<category lang="en">{}</category>'.format(escape(epg['genre'])) if epg['genre'] else ''
-
-                    subtitle = u'<subtitle>{}</subtitle>'.format(escape(epg['subTitle']).strip()) if epg['subTitle'] else ''
-                    if not subtitle:
-                        subtitle = u'<subtitle>{}</subtitle>'.format(escape(epg['subTitle2']).strip()) if epg['subTitle2'] else ''
-
-                    f.write(u'<programme channel="{id}" start="{start}" stop="{stop}"><title>{title}</title>{subtitle}{desc}{icon}{genre}</programme>'.format(
-                        id=channel['channelId'], start=start.format('YYYYMMDDHHmmss Z'), stop=stop.format('YYYYMMDDHHmmss Z'), title=escape(epg['title']), 
-                        subtitle=subtitle, desc=desc, icon=icon, genre=genre,
-                    ))
+                    icon = IMAGE_URL.format(url=epg['mediaImage']['url'], width=IMAGE_WIDTH) if epg['mediaImage'].get('url') else None
+                    subtitle = (epg['subTitle'] or '').strip() or (epg['subTitle2'] or '').strip()
 
-        f.write(u'</tv>')
+                    writer.programme(channel['channelId'], epg['startTime'], epg['endTime'], epg['title'], subtitle=subtitle, desc=epg['synopsis'], icon=icon, genre=epg['genre'], genre_lang='en')
 
 
 @plugin.route()
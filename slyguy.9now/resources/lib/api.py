@@ -7,15 +7,15 @@ class API(object):
     def __init__(self):
         self._session = Session(HEADERS, base_url=API_URL)
 
-    @mem_cache.cached(60*30)
+    @mem_cache.cached(60*30, stale_ttl=60*60)
     def featured(self):
         return self._session.get('/home', params={'device': 'web'}).json()
 
-    @mem_cache.cached(60*30)
+    @mem_cache.cached(60*30, stale_ttl=60*60)
     def shows(self):
         return self._session.get('/tv-series', params={'device': 'web'}).json()['tvSeries']
 
-    @mem_cache.cached(60*30)
+    @mem_cache.cached(60*30, stale_ttl=60*60)
     def show(self, show):
         return self._session.get('/tv-series/{show}'.format(show=show), params={'device': 'web'}).json()
 
@@ -46,11 +46,11 @@ class API(object):
 
         return self._session.get('/tv-series/{show}/seasons/{season}/clips'.format(show=show, season=season), params=params).json()
 
-    @mem_cache.cached(60*30)
+    @mem_cache.cached(60*30, stale_ttl=60*60)
     def categories(self):
         return self._session.get('/genres', params={'device': 'web'}).json()['genres']
 
-    @mem_cache.cached(60*30)
+    @mem_cache.cached(60*30, stale_ttl=60*60)
     def category(self, category):
         return self._session.get('/genres/{category}'.format(category=category), params={'device': 'web'}).json()
 
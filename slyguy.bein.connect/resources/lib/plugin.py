@@ -1,9 +1,9 @@
 import codecs
-from xml.sax.saxutils import escape
 
 import arrow
 from slyguy import plugin, gui, settings, userdata, signals, inputstream
 from slyguy.exceptions import PluginError
+from slyguy.xmltv import open_xmltv
 
 from .api import API
 from .language import _
@@ -119,16 +119,13 @@ def playlist(output, **kwargs):
 @plugin.merge()
 @plugin.login_required()
 def epg(output, **kwargs):
-    with codecs.open(output, 'w', encoding='utf8') as f:
-        f.write(u'<?xml version="1.0" encoding="utf-8" ?><tv>')
-
+    with open_xmltv(output) as writer:
         ids = []
         for row in api.channels():
             if not api.logged_in and not row['isFta']:
                 continue
 
-            f.write(u'<channel id="{}"><display-name>{}</display-name><icon src="{}"/></channel>'.format(
-                row['idChannel'], escape(row.get('epg_name', row['name'])), escape(row.get('logo'))))
+            writer.channel(row['idChannel'], name=row.get('epg_name', row['name']), icon=row.get('logo'))
 
             ids.append(row['idChannel'])
 
@@ -145,10 +142,4 @@ def epg(output, **kwargs):
 
             for channel in data:
                 for event in data[channel]:
-                    genre = event.get('genre')
-
-                    f.write(u'<programme channel="{}" start="{}" stop="{}"><title>{}</title><desc>{}</desc>{}</programme>'.format(
-                        event['id_channel'], arrow.get(event['startutc']).format('YYYYMMDDHHmmss Z'), arrow.get(event['endutc']).format('YYYYMMDDHHmmss Z'),
-                            escape(event.get('title')), escape(event.get('synopsis')), u'<category>{}</category>'.format(escape(genre)) if genre else '',))
-
-        f.write(u'</tv>')
\ No newline at end of file
+                    writer.programme(event['id_channel'], event['startutc'], event['endutc'], event.get('title'), desc=event.get('synopsis'), genre=event.get('genre'))
\ No newline at end of file
@@ -1,6 +1,5 @@
 import time
 import codecs
-from xml.sax.saxutils import escape
 from xml.dom.minidom import parseString
 
 import arrow
@@ -8,6 +7,7 @@ from kodi_six import xbmc
 
 from slyguy import plugin, gui, settings, userdata, signals, inputstream
 from slyguy.exceptions import PluginError
+from slyguy.xmltv import open_xmltv
 
 from .api import API
 from .language import _
@@ -571,14 +571,12 @@ def epg(output, **kwargs):
     now = arrow.now()
     until = now.shift(days=settings.getInt('epg_days', 3))
 
-    with codecs.open(output, 'w', encoding='utf8') as f:
-        f.write(u'<?xml version="1.0" encoding="utf-8" ?><tv>')
-
+    with open_xmltv(output) as writer:
         for channel in api.live_channels():
             if not channel['currentListing'] or (not channel['dma'] and not channel['currentListing'][-1]['contentCANVideo'].get('liveStreamingUrl')):
                 continue
 
-            f.write(u'<channel id="{id}"></channel>'.format(id=channel['slug']))
+            writer.channel(channel['slug'])
 
             page = 1
             stop = now
@@ -589,14 +587,6 @@ def epg(output, **kwargs):
                     break
 
                 for row in rows:
-                    start = arrow.get(row['startTimestamp'])
                     stop = arrow.get(row['endTimestamp'])
-
-                    icon = u'<icon src="{}"/>'.format(config.image(row['filePathThumb'])) if row['filePathThumb'] else ''
-                    desc = u'<desc>{}</desc>'.format(escape(row['description'])) if row['description'] else ''
-
-                    f.write(u'<programme channel="{id}" start="{start}" stop="{stop}"><title>{title}</title>{desc}{icon}</programme>'.format(
-                        id=channel['slug'], start=start.format('YYYYMMDDHHmmss Z'), stop=stop.format('YYYYMMDDHHmmss Z'), title=escape(row['title']), desc=desc, icon=icon,
-                    ))
-
-        f.write(u'</tv>')
+                    icon = config.image(row['filePathThumb']) if row['filePathThumb'] else None
+                    writer.programme(channel['slug'], row['startTimestamp'], row['endTimestamp'], row['title'], desc=row['description'], icon=icon)